@@ -12,7 +12,12 @@ import sys
 import io
 import os
 import importlib.util
+import json
+import subprocess
+import tempfile
+import time
 from importlib.machinery import SourceFileLoader
+from typing import Any, Dict, List, Optional, Tuple
 
 # Get absolute path of bench script to import it dynamically
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -27,10 +32,27 @@ if spec is not None and spec.loader is not None:
 else:
     raise ImportError("Could not import bench")
 
+def make_rusage(utime: float = 0.05, stime: float = 0.01, maxrss: int = 2048) -> MagicMock:
+    ru = MagicMock()
+    ru.ru_utime = utime
+    ru.ru_stime = stime
+    ru.ru_maxrss = maxrss
+    for name in ("ru_minflt", "ru_majflt", "ru_nvcsw", "ru_nivcsw", "ru_inblock", "ru_oublock"):
+        setattr(ru, name, 1)
+    return ru
+
 class TestBench(unittest.TestCase):
-    @patch("subprocess.run")
+    def setUp(self) -> None:
+        # main() reports the governor and turbo state of the host CPUs; keep the tests hermetic.
+        self.report_cpu_state = bench.report_cpu_state
+        patcher = patch("bench.report_cpu_state")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("os.wait4")
+    @patch("subprocess.Popen")
     @patch("time.perf_counter")
-    def test_run_benchmark(self, mock_perf_counter: MagicMock, mock_run: MagicMock) -> None:
+    def test_run_benchmark(self, mock_perf_counter: MagicMock, mock_run: MagicMock, mock_wait4: MagicMock) -> None:
         # We will mock the returns for perf_counter.
         # 10 runs means 20 calls to perf_counter (start and end for each run).
         # Let's say it takes 0.1s for each run.
@@ -39,20 +61,20 @@ class TestBench(unittest.TestCase):
             counter_values.extend([float(i), float(i) + 0.1])
         mock_perf_counter.side_effect = counter_values
         
-        mock_result = MagicMock()
-        mock_result.returncode = 0
-        mock_run.return_value = mock_result
+        mock_run.return_value = MagicMock(pid=1234)
+        mock_wait4.return_value = (1234, 0, make_rusage())
         
         # Capture stdout and stderr
         captured_stdout = io.StringIO()
         captured_stderr = io.StringIO()
         
         with patch("sys.stdout", captured_stdout), patch("sys.stderr", captured_stderr):
-            bench.run_benchmark(["echo", "ok"], 10)
+            bench.run_benchmark(["echo", "ok"], 10, verbose=True)
             
-        # Verify run_benchmark called subprocess.run 10 times with the correct arguments
+        # Verify run_benchmark called subprocess.Popen 10 times with the correct arguments
         self.assertEqual(mock_run.call_count, 10)
         mock_run.assert_called_with(["echo", "ok"], stdout=None, stderr=None)
+        mock_wait4.assert_called_with(1234, 0)
         
         # Verify output
         stdout_output = captured_stdout.getvalue()
@@ -62,15 +84,23 @@ class TestBench(unittest.TestCase):
         self.assertIn("Min real time:     0.1000s", stderr_output)
         self.assertIn("Max real time:     0.1000s", stderr_output)
         self.assertIn("--- Run 10/10 ---", stderr_output)
+        self.assertIn("User CPU time:            0.0500s / 0.0500s / 0.0500s", stderr_output)
+        self.assertIn("Max RSS:                  2048.0 / 2048 / 2048 KiB", stderr_output)
 
     @patch("subprocess.run")
     @patch("sys.argv")
     def test_main_arguments(self, mock_argv: MagicMock, mock_run: MagicMock) -> None:
         # Test command line parsing
         with patch("sys.argv", ["bench", "-n", "3", "sleep", "1"]):
-            with patch("bench.run_benchmark") as mock_run_benchmark:
+            with patch("bench.run_benchmark", return_value={"aborted": False}) as mock_run_benchmark:
                 bench.main()
-                mock_run_benchmark.assert_called_once_with(["sleep", "1"], 3, no_stdout=False, no_stderr=False)
+                mock_run_benchmark.assert_called_once()
+                args, kwargs = mock_run_benchmark.call_args
+                self.assertEqual(args, (["sleep", "1"], 3))
+                self.assertFalse(kwargs["no_stdout"])
+                self.assertFalse(kwargs["no_stderr"])
+                self.assertEqual(kwargs["warmup"], 0)
+                self.assertIsNone(kwargs["target_rsd"])
 
     @patch("sys.argv")
     def test_main_invalid_count(self, mock_argv: MagicMock) -> None:
@@ -81,14 +111,14 @@ class TestBench(unittest.TestCase):
                     bench.main()
                 self.assertIn("count must be a positive integer", captured_stderr.getvalue())
 
-    @patch("subprocess.run")
+    @patch("os.wait4")
+    @patch("subprocess.Popen")
     @patch("time.perf_counter")
-    def test_run_benchmark_suppress(self, mock_perf_counter: MagicMock, mock_run: MagicMock) -> None:
+    def test_run_benchmark_suppress(self, mock_perf_counter: MagicMock, mock_run: MagicMock, mock_wait4: MagicMock) -> None:
         # Test run_benchmark with no_stdout=True and no_stderr=True
         mock_perf_counter.side_effect = [0.0, 0.1]
-        mock_result = MagicMock()
-        mock_result.returncode = 0
-        mock_run.return_value = mock_result
+        mock_run.return_value = MagicMock(pid=1234)
+        mock_wait4.return_value = (1234, 0, make_rusage())
         
         captured_stdout = io.StringIO()
         captured_stderr = io.StringIO()
@@ -104,11 +134,718 @@ class TestBench(unittest.TestCase):
     def test_main_arguments_suppress(self, mock_argv: MagicMock, mock_run: MagicMock) -> None:
         # Test command line parsing with suppression options
         with patch("sys.argv", ["bench", "--no-stdout", "--no-stderr", "sleep", "1"]):
-            with patch("bench.run_benchmark") as mock_run_benchmark:
+            with patch("bench.run_benchmark", return_value={"aborted": False}) as mock_run_benchmark:
+                bench.main()
+                mock_run_benchmark.assert_called_once()
+                args, kwargs = mock_run_benchmark.call_args
+                self.assertEqual(args, (["sleep", "1"], 10))
+                self.assertTrue(kwargs["no_stdout"])
+                self.assertTrue(kwargs["no_stderr"])
+
+    @patch("sys.argv")
+    def test_main_arguments_statistics(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "-w", "2", "--target-rsd", "1.5", "--max-count", "50",
+                                "--reject-outliers", "sleep", "1"]):
+            with patch("bench.run_benchmark", return_value={"aborted": False}) as mock_run_benchmark:
+                bench.main()
+                _, kwargs = mock_run_benchmark.call_args
+                self.assertEqual(kwargs["warmup"], 2)
+                self.assertEqual(kwargs["target_rsd"], 1.5)
+                self.assertEqual(kwargs["max_count"], 50)
+                self.assertTrue(kwargs["reject_outliers"])
+
+    def test_percentile(self) -> None:
+        values = [1.0, 2.0, 3.0, 4.0, 5.0]
+        self.assertEqual(bench.percentile(values, 0), 1.0)
+        self.assertEqual(bench.percentile(values, 50), 3.0)
+        self.assertEqual(bench.percentile(values, 100), 5.0)
+        self.assertAlmostEqual(bench.percentile(values, 90), 4.6)
+        self.assertEqual(bench.percentile([7.0], 99), 7.0)
+
+    def test_compute_stats(self) -> None:
+        stats = bench.compute_stats([2.0, 4.0, 4.0, 4.0, 5.0, 5.0, 7.0, 9.0])
+        self.assertEqual(stats["mean"], 5.0)
+        self.assertEqual(stats["median"], 4.5)
+        self.assertAlmostEqual(stats["stddev"], 2.1380899, places=6)
+        self.assertEqual(stats["min"], 2.0)
+        self.assertEqual(stats["max"], 9.0)
+
+    def test_bootstrap_ci(self) -> None:
+        import random
+        times = [1.0 + 0.01 * (i % 5) for i in range(50)]
+        lo, hi = bench.bootstrap_ci(times, rng=random.Random(1))
+        mean = sum(times) / len(times)
+        self.assertLessEqual(lo, mean)
+        self.assertGreaterEqual(hi, mean)
+        self.assertLess(bench.relative_ci_width((lo, hi), mean), 1.0)
+        self.assertEqual(bench.bootstrap_ci([0.5]), (0.5, 0.5))
+
+    def test_outliers(self) -> None:
+        times = [1.0, 1.01, 0.99, 1.02, 0.98, 1.0, 5.0]
+        self.assertEqual(bench.find_outliers_mad(times), [6])
+        self.assertEqual(bench.find_outliers_iqr(times), [6])
+        self.assertEqual(bench.find_outliers_mad([1.0] * 5), [])
+
+    @patch("bench.run_once")
+    def test_run_benchmark_warmup_and_target(self, mock_run: MagicMock) -> None:
+        # With a constant duration, the CI collapses as soon as the minimum count is reached
+        # so no extra runs are made.
+        mock_run.return_value = (0.2, 0, bench.rusage_to_dict(make_rusage()))
+        captured_stdout = io.StringIO()
+        captured_stderr = io.StringIO()
+        with patch("sys.stdout", captured_stdout), patch("sys.stderr", captured_stderr):
+            bench.run_benchmark(["true"], 3, warmup=2, target_rsd=1.0)
+        self.assertEqual(mock_run.call_count, 5)
+        self.assertIn("Average real time: 0.2000s", captured_stdout.getvalue())
+        self.assertIn("95% CI of mean:    [0.2000s, 0.2000s]", captured_stderr.getvalue())
+        # Without --verbose, individual runs are not logged.
+        self.assertNotIn("--- Run", captured_stderr.getvalue())
+        self.assertIn("=== Histogram ===", captured_stderr.getvalue())
+
+    @patch("bench.run_once")
+    def test_run_benchmark_target_bootstraps_once(self, mock_run: MagicMock) -> None:
+        usage = bench.rusage_to_dict(make_rusage())
+        mock_run.side_effect = [(0.2 + 0.01 * (i % 2), 0, usage) for i in range(1000)]
+        with patch("sys.stdout", io.StringIO()), patch("sys.stderr", io.StringIO()), \
+                patch("bench.bootstrap_ci", wraps=bench.bootstrap_ci) as mock_bootstrap:
+            record = bench.run_benchmark(["true"], 3, target_rsd=1.0)
+        # The CI of +/-0.005s around 0.205s narrows below 1% after ~23 runs.
+        self.assertTrue(20 <= mock_run.call_count <= 30, mock_run.call_count)
+        self.assertEqual(mock_bootstrap.call_count, 1)
+        # The reported (bootstrapped) CI agrees with the normal approximation.
+        self.assertAlmostEqual(bench.relative_ci_width((record["stats"]["ci_low"], record["stats"]["ci_high"]),
+                                                       record["stats"]["mean"]), 1.0, delta=0.2)
+
+    def test_normal_relative_ci_width(self) -> None:
+        times = [1.0, 1.1, 0.9, 1.05]
+        mean = sum(times) / len(times)
+        m2 = sum((t - mean) ** 2 for t in times)
+        stddev = (m2 / 3) ** 0.5
+        self.assertAlmostEqual(bench.normal_relative_ci_width(4, mean, m2), 1.96 * stddev / 2 / mean * 100, places=2)
+        self.assertEqual(bench.normal_relative_ci_width(1, 1.0, 0.0), float("inf"))
+
+    def test_mann_whitney_u(self) -> None:
+        u, p = bench.mann_whitney_u([1.0, 2.0, 3.0], [4.0, 5.0, 6.0])
+        self.assertEqual(u, 0.0)
+        self.assertAlmostEqual(p, 0.0809, places=4)
+        # Identical samples are never significant.
+        _, p = bench.mann_whitney_u([1.0] * 5, [1.0] * 5)
+        self.assertEqual(p, 1.0)
+
+    def test_run_comparison(self) -> None:
+        durations = {"fast": 0.1, "slow": 0.2}
+        calls: List[List[str]] = []
+        def fake_run_once(command: List[str], stdout_dest: Any, stderr_dest: Any,
+                          timeout: Optional[float] = None,
+                          counters: Optional[List[str]] = None) -> Tuple[float, int, Dict[str, float]]:
+            calls.append(command)
+            return (durations[command[0]] + 0.001 * (len(calls) % 3), 0, {})
+
+        captured_stdout = io.StringIO()
+        with patch("bench.run_once", side_effect=fake_run_once), \
+                patch("sys.stdout", captured_stdout), patch("sys.stderr", io.StringIO()):
+            status = bench.run_comparison(["fast", "slow --flag"], 10, warmup=1, fail_on_regression=True)
+        # (10 rounds + 1 warmup) x 2 commands
+        self.assertEqual(len(calls), 22)
+        self.assertIn(["slow", "--flag"], calls)
+        self.assertEqual(status, 1)
+        out = captured_stdout.getvalue()
+        self.assertIn("slower", out)
+        self.assertIn(": significant", out)
+
+    @patch("sys.argv")
+    def test_main_compare_requires_two_commands(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--compare", "sleep 1"]):
+            captured_stderr = io.StringIO()
+            with patch("sys.stderr", captured_stderr):
+                with self.assertRaises(SystemExit):
+                    bench.main()
+                self.assertIn("--compare requires at least two commands", captured_stderr.getvalue())
+
+    def test_run_once_real_process(self) -> None:
+        # Runs an actual child to make sure it is reaped exactly once and its usage is reported.
+        elapsed, returncode, usage = bench.run_once([sys.executable, "-c", "import sys; sys.exit(3)"], None, None)
+        self.assertEqual(returncode, 3)
+        self.assertGreater(elapsed, 0)
+        self.assertGreater(usage["maxrss"], 0)
+        self.assertGreaterEqual(usage["user"] + usage["sys"], 0)
+
+    def make_record(self, walls: List[float], command: List[str] = ["cmd"]) -> Dict[str, Any]:
+        samples = [{"wall": w, "returncode": 0} for w in walls]
+        return {"command": command, "samples": samples, "stats": bench.compute_stats(walls),
+                "metadata": {"timestamp": "2026-01-01T00:00:00+00:00", "git_rev": "abc123"}}
+
+    def test_export_json_and_csv(self) -> None:
+        record = self.make_record([0.1, 0.2])
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "out.json")
+            csv_path = os.path.join(tmp, "out.csv")
+            bench.write_json(record, json_path)
+            bench.write_csv(record, csv_path)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f)["samples"][1]["wall"], 0.2)
+            with open(csv_path) as f:
+                lines = f.read().splitlines()
+        self.assertTrue(lines[0].startswith("command,run,wall,returncode,user,"))
+        self.assertEqual(len(lines), 3)
+        self.assertIn("abc123", lines[2])
+
+    def test_history_and_regression(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub", "history.jsonl")
+            base = [1.0 + 0.01 * (i % 4) for i in range(20)]
+            bench.append_history(self.make_record(base), path)
+            bench.append_history(self.make_record(base, ["other"]), path)
+            bench.append_history(self.make_record([w * 1.5 for w in base]), path)
+            with open(path, "a") as f:
+                f.write("not json\n")
+
+            records = bench.load_history(path, ["cmd"])
+            self.assertEqual(len(records), 2)
+            self.assertEqual(len(bench.load_history(path)), 3)
+
+            ratio, p = bench.check_regression(records[1], records[:1])
+            self.assertAlmostEqual(ratio, 1.5)
+            self.assertIn("REGRESSION", bench.format_regression(ratio, p, bench.DEFAULT_ALPHA))
+            self.assertIsNone(bench.check_regression(records[0], []))
+
+            captured_stdout = io.StringIO()
+            with patch("sys.stdout", captured_stdout), \
+                    patch("sys.argv", ["bench", "--history", "--history-file", path, "cmd"]):
+                bench.main()
+            out = captured_stdout.getvalue()
+            self.assertIn("=== cmd (2 sessions) ===", out)
+            self.assertIn("+50.0%", out)
+            self.assertNotIn("other", out)
+
+    def test_main_record(self) -> None:
+        record = self.make_record([0.1, 0.1])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.jsonl")
+            json_path = os.path.join(tmp, "out.json")
+            with patch("sys.argv", ["bench", "--record", "--history-file", path, "--json", json_path, "cmd"]), \
+                    patch("bench.run_benchmark", return_value=dict(record)), \
+                    patch("bench.collect_metadata", return_value={"host": "h"}):
+                bench.main()
+            self.assertEqual(bench.load_history(path)[0]["metadata"], {"host": "h"})
+            self.assertTrue(os.path.exists(json_path))
+
+    def test_run_load(self) -> None:
+        usage = {"user": 0.01, "sys": 0.0}
+        captured_stdout = io.StringIO()
+        with patch("bench.run_once", return_value=(0.1, 0, usage)) as mock_run, \
+                patch("sys.stdout", captured_stdout), patch("sys.stderr", io.StringIO()):
+            levels = bench.run_load(["cmd"], 4, 3, warmup=1)
+        # 1 warmup + 4 runs at each of the 3 levels.
+        self.assertEqual(mock_run.call_count, 13)
+        self.assertEqual([level["jobs"] for level in levels], [1.0, 2.0, 3.0])
+        self.assertEqual(levels[2]["median"], 0.1)
+        self.assertGreater(levels[0]["throughput"], 0)
+        self.assertIn("runs/s", captured_stdout.getvalue())
+
+    def test_run_load_failures(self) -> None:
+        results = [(0.1, 0, {}), (5.0, 1, {}), (0.3, 0, {}), (9.0, -9, {"timed_out": True})]
+        with patch("sys.stdout", io.StringIO()), patch("sys.stderr", io.StringIO()):
+            with patch("bench.run_once", side_effect=results):
+                level, = bench.run_load(["cmd"], 4, 1)
+            self.assertEqual((level["failures"], level["median"], level["max"]), (2.0, 0.2, 0.3))
+            with patch("bench.run_once", side_effect=results):
+                level, = bench.run_load(["cmd"], 4, 1, include_failed=True)
+            self.assertEqual((level["failures"], level["max"]), (2.0, 9.0))
+
+    @patch("sys.argv")
+    def test_main_jobs(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "-j", "4", "-n", "8", "cmd"]), \
+                patch("bench.run_load") as mock_run_load:
+            bench.main()
+            mock_run_load.assert_called_once_with(["cmd"], 8, 4, no_stdout=False, no_stderr=False, warmup=0,
+                                                  timeout=None, include_failed=False)
+        for options in (["--compare", "a", "b"], ["--param", "n=1,2", "--", "cmd", "{n}"],
+                        ["--max-failures", "1", "cmd"], ["--reject-outliers", "cmd"]):
+            with patch("sys.argv", ["bench", "-j", "2"] + options), patch("sys.stderr", io.StringIO()), \
+                    patch("bench.run_load") as mock_run_load:
+                with self.assertRaises(SystemExit):
+                    bench.main()
+                mock_run_load.assert_not_called()
+
+    def test_parse_params(self) -> None:
+        self.assertEqual(bench.parse_params(["n=1,10", "mode=a"]), [("n", ["1", "10"]), ("mode", ["a"])])
+        for bad in (["n"], ["1n=1"], ["n="], ["n=1", "n=2"]):
+            with self.assertRaises(ValueError):
+                bench.parse_params(bad)
+
+    def test_expand_command(self) -> None:
+        self.assertEqual(bench.expand_command(["sort", "data_{n}.txt", "{print $1}", "-{m}{n}"], {"n": "10", "m": "k"}),
+                         ["sort", "data_10.txt", "{print $1}", "-k10"])
+
+    def test_fit_exponent(self) -> None:
+        xs = [10.0, 100.0, 1000.0]
+        self.assertAlmostEqual(bench.fit_exponent(xs, [x ** 2 * 3 for x in xs]), 2.0)
+        self.assertAlmostEqual(bench.fit_exponent(xs, [x * 0.5 for x in xs]), 1.0)
+        self.assertIsNone(bench.fit_exponent([5.0, 5.0], [1.0, 2.0]))
+
+    def test_run_sweep(self) -> None:
+        def fake_run_benchmark(command: List[str], count: int, **kwargs: Any) -> Dict[str, Any]:
+            n = float(command[1])
+            return {"command": command, "samples": [], "stats": bench.compute_stats([n * n * 1e-6])}
+
+        captured_stdout = io.StringIO()
+        with patch("bench.run_benchmark", side_effect=fake_run_benchmark) as mock_run_benchmark, \
+                patch("sys.stdout", captured_stdout), patch("sys.stderr", io.StringIO()):
+            sweep = bench.run_sweep(["cmd", "{n}", "{flag}"], [("n", ["10", "100"]), ("flag", ["x", "y"])], 3)
+        self.assertEqual(mock_run_benchmark.call_count, 4)
+        self.assertEqual(sweep["cells"][3]["command"], ["cmd", "100", "y"])
+        self.assertEqual(sweep["cells"][3]["params"], {"n": "100", "flag": "y"})
+        self.assertEqual(len(sweep["exponents"]), 2)
+        self.assertAlmostEqual(sweep["exponents"][0]["exponent"], 2.0)
+        self.assertIn("Scaling exponent for n: 2.00 (flag=x)", captured_stdout.getvalue())
+
+    def test_run_iteration_hooks(self) -> None:
+        events: List[str] = []
+        with patch("bench.run_hook", side_effect=lambda name, hook, *a: events.append(f"{name}:{hook}")), \
+                patch("bench.drop_page_cache", side_effect=lambda files: events.append(f"cold:{files}")), \
+                patch("bench.run_once", side_effect=lambda *a: events.append("run") or (0.1, 0, {})):
+            result = bench.run_iteration(["cmd"], None, None, prepare="p", cleanup="c", cold_files=["f"])
+        self.assertEqual(result, (0.1, 0, {}))
+        self.assertEqual(events, ["prepare:p", "cold:['f']", "run", "cleanup:c"])
+
+    def test_run_hook_failure(self) -> None:
+        bench.run_hook("prepare", None, None, None)
+        bench.run_hook("prepare", "true", None, None)
+        with self.assertRaises(SystemExit) as cm:
+            bench.run_hook("cleanup", "exit 3", None, None)
+        self.assertIn("cleanup command failed with status 3", str(cm.exception.code))
+
+    def test_drop_page_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "d"))
+            for name in ("a", os.path.join("d", "b")):
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write("data")
+            with patch("os.posix_fadvise") as mock_fadvise:
+                bench.drop_page_cache([os.path.join(tmp, "a"), os.path.join(tmp, "d")])
+            self.assertEqual(mock_fadvise.call_count, 2)
+            self.assertEqual(mock_fadvise.call_args[0][1:], (0, 0, os.POSIX_FADV_DONTNEED))
+            # Missing files only produce a warning.
+            with patch("sys.stderr", io.StringIO()) as captured_stderr:
+                bench.drop_page_cache([os.path.join(tmp, "missing")])
+            self.assertIn("Warning", captured_stderr.getvalue())
+
+    @patch("sys.argv")
+    def test_main_hooks(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--prepare", "make clean", "--cleanup", "rm x", "--cold", "a",
+                                "--cold", "b", "make"]), \
+                patch("bench.run_benchmark", return_value={"aborted": False}) as mock_run_benchmark:
+            bench.main()
+            _, kwargs = mock_run_benchmark.call_args
+            self.assertEqual(kwargs["prepare"], "make clean")
+            self.assertEqual(kwargs["cleanup"], "rm x")
+            self.assertEqual(kwargs["cold_files"], ["a", "b"])
+
+    def test_measure(self) -> None:
+        calls: List[str] = []
+        record = bench.measure(lambda: calls.append("f"), setup=lambda: calls.append("setup"),
+                               repeat=5, number=3, warmup=1, name="append")
+        # (1 initial + 1 warmup + 5 samples) setups, (1 warmup + 5 samples) x 3 calls
+        self.assertEqual(calls.count("setup"), 7)
+        self.assertEqual(calls.count("f"), 18)
+        self.assertEqual(record["name"], "append")
+        self.assertEqual(record["number"], 3)
+        self.assertEqual(len(record["samples"]), 5)
+        self.assertIn("ci_low", record["stats"])
+        self.assertIn("append: median ", bench.format_measurement(record))
+        self.assertTrue(__import__("gc").isenabled())
+
+    def test_measure_disables_gc(self) -> None:
+        import gc
+        states: List[bool] = []
+        bench.measure(lambda: states.append(gc.isenabled()), repeat=2, number=2, warmup=0)
+        self.assertEqual(states, [False] * 4)
+        self.assertTrue(gc.isenabled())
+
+    def test_calibrate(self) -> None:
+        with patch("time.perf_counter", side_effect=[0.0, 0.001, 0.0, 0.002, 0.0, 0.02]):
+            self.assertEqual(bench.calibrate(lambda: None, 0.01), 5)
+
+    def test_format_duration(self) -> None:
+        self.assertEqual(bench.format_duration(1.5), "1.500s")
+        self.assertEqual(bench.format_duration(0.0025), "2.500ms")
+        self.assertEqual(bench.format_duration(3e-6), "3.000us")
+        self.assertEqual(bench.format_duration(4e-8), "40.0ns")
+
+    def test_progress(self) -> None:
+        class TTYStringIO(io.StringIO):
+            def isatty(self) -> bool:
+                return True
+
+        stream = TTYStringIO()
+        progress = bench.Progress(4, stream=stream, interval=0)
+        for t in (0.1, 0.3, 0.2):
+            progress.add(t)
+        self.assertIn("\rrun 3/4, mean 200.000ms, median 200.000ms, ETA ", stream.getvalue())
+        progress.finish()
+        self.assertTrue(stream.getvalue().endswith("\r"))
+
+        # A long interval throttles the redraws.
+        stream = TTYStringIO()
+        progress = bench.Progress(None, stream=stream, interval=3600)
+        progress.add(0.1)
+        progress.add(0.1)
+        self.assertEqual(stream.getvalue().count("\r"), 1)
+        self.assertNotIn("ETA", stream.getvalue())
+
+        # Nothing is drawn when the stream is not a terminal.
+        stream = io.StringIO()
+        progress = bench.Progress(4, stream=stream, interval=0)
+        progress.add(0.1)
+        progress.finish()
+        self.assertEqual(stream.getvalue(), "")
+
+    def test_print_histogram(self) -> None:
+        out = io.StringIO()
+        bench.print_histogram([0.1, 0.1, 0.1, 0.1, 0.2], bins=2, width=8, file=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "=== Histogram ===")
+        self.assertTrue(lines[1].endswith("     4 ████████"))
+        self.assertTrue(lines[2].endswith("     1 ██"))
+        out = io.StringIO()
+        bench.print_histogram([0.5, 0.5], file=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+    def test_parse_cpu_list(self) -> None:
+        self.assertEqual(bench.parse_cpu_list("2,3"), [2, 3])
+        self.assertEqual(bench.parse_cpu_list("4-6,0,5"), [0, 4, 5, 6])
+        for bad in ("", "a", "3-1", "-1"):
+            with self.assertRaises(ValueError):
+                bench.parse_cpu_list(bad)
+
+    def test_cpu_state(self) -> None:
+        sysfs = {
+            "/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor": "powersave",
+            "/sys/devices/system/cpu/cpu1/cpufreq/scaling_governor": "performance",
+            "/sys/devices/system/cpu/intel_pstate/no_turbo": "0",
+        }
+        with patch("bench.read_first_line", side_effect=sysfs.get), \
+                patch("sys.stderr", io.StringIO()) as captured_stderr:
+            self.assertTrue(bench.get_turbo_state())
+            self.report_cpu_state([0, 1])
+        out = captured_stderr.getvalue()
+        self.assertIn("CPU governor: powersave (cpu 0); performance (cpu 1), turbo: enabled", out)
+        self.assertIn("'performance' governor", out)
+        self.assertIn("turbo boost is enabled", out)
+
+        with patch("bench.read_first_line", side_effect={"/sys/devices/system/cpu/cpufreq/boost": "0"}.get):
+            self.assertFalse(bench.get_turbo_state())
+        with patch("bench.read_first_line", return_value=None):
+            self.assertIsNone(bench.get_turbo_state())
+
+    def test_apply_isolation(self) -> None:
+        with patch("os.sched_setaffinity") as mock_affinity, \
+                patch("os.setpriority") as mock_setpriority, \
+                patch("os.sched_setscheduler", side_effect=PermissionError("denied")) as mock_scheduler, \
+                patch("sys.stderr", io.StringIO()) as captured_stderr:
+            bench.apply_isolation([2, 3], 5, 10)
+        mock_affinity.assert_called_once_with(0, [2, 3])
+        mock_setpriority.assert_called_once_with(os.PRIO_PROCESS, 0, 5)
+        self.assertEqual(mock_scheduler.call_args[0][1], os.SCHED_FIFO)
+        self.assertIn("SCHED_FIFO is not permitted", captured_stderr.getvalue())
+
+        with patch("os.sched_setaffinity") as mock_affinity, patch("os.setpriority") as mock_setpriority:
+            bench.apply_isolation(None, None, None)
+        mock_affinity.assert_not_called()
+        mock_setpriority.assert_not_called()
+
+    @patch("sys.argv")
+    def test_main_isolation(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--cpus", "0-1", "--nice", "3", "--fifo", "cmd"]), \
+                patch("bench.apply_isolation") as mock_apply, \
+                patch("bench.run_benchmark", return_value={"aborted": False}):
+            bench.main()
+            mock_apply.assert_called_once_with([0, 1], 3, 1)
+        with patch("sys.argv", ["bench", "--fifo-priority", "5", "cmd"]), \
+                patch("bench.apply_isolation") as mock_apply, \
+                patch("bench.run_benchmark", return_value={"aborted": False}):
+            bench.main()
+            mock_apply.assert_called_once_with(None, None, None)
+        with patch("sys.argv", ["bench", "--cpus", "x", "cmd"]), patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                bench.main()
+
+    def test_run_once_timeout(self) -> None:
+        elapsed, returncode, usage = bench.run_once(["sleep", "5"], None, None, timeout=0.1)
+        self.assertEqual(usage["timed_out"], 1.0)
+        self.assertEqual(bench.status_name(returncode, usage), "timeout")
+        self.assertLess(elapsed, 5)
+        _, returncode, usage = bench.run_once(["true"], None, None, timeout=5)
+        self.assertEqual((returncode, usage["timed_out"]), (0, 0.0))
+
+    def test_status_name(self) -> None:
+        self.assertEqual(bench.status_name(0, {}), "0")
+        self.assertEqual(bench.status_name(2, {"timed_out": 0.0}), "2")
+        self.assertEqual(bench.status_name(-11, {}), "SIGSEGV")
+
+    def run_with_results(self, results: List[Tuple[float, int, Dict[str, float]]],
+                         **kwargs: Any) -> Tuple[Dict[str, Any], str, MagicMock]:
+        usage = bench.rusage_to_dict(make_rusage())
+        side_effect = [(wall, rc, {**usage, **extra}) for wall, rc, extra in results]
+        captured_stderr = io.StringIO()
+        with patch("bench.run_once", side_effect=side_effect) as mock_run, \
+                patch("sys.stdout", io.StringIO()), patch("sys.stderr", captured_stderr):
+            record = bench.run_benchmark(["cmd"], len(results), **kwargs)
+        return record, captured_stderr.getvalue(), mock_run
+
+    def test_run_benchmark_failures(self) -> None:
+        results = [(0.1, 0, {}), (0.1, 0, {}), (0.5, 1, {}), (2.0, -9, {"timed_out": 1.0})]
+        record, err, mock_run = self.run_with_results(results, timeout=2.0)
+        self.assertEqual(mock_run.call_args[0][3], 2.0)
+        self.assertEqual(record["failures"], 2)
+        self.assertFalse(record["aborted"])
+        self.assertEqual(record["stats"]["mean"], 0.1)
+        self.assertEqual(len(record["samples"]), 4)
+        self.assertIn("2 failed run(s) excluded", err)
+        self.assertIn("   timeout:     1 runs", err)
+        self.assertIn("         1:     1 runs", err)
+
+        record, _, _ = self.run_with_results(results, include_failed=True)
+        self.assertAlmostEqual(record["stats"]["mean"], 0.675)
+
+    def test_run_benchmark_max_failures(self) -> None:
+        results = [(0.1, 0, {}), (0.2, 1, {}), (0.2, 1, {}), (0.1, 0, {}), (0.1, 0, {})]
+        record, err, mock_run = self.run_with_results(results, max_failures=1)
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertTrue(record["aborted"])
+        self.assertIn("Aborted after 2 failed runs", err)
+
+    def test_run_benchmark_all_failed(self) -> None:
+        record, err, _ = self.run_with_results([(0.3, 1, {}), (0.3, 1, {})])
+        self.assertEqual(record["stats"]["mean"], 0.3)
+        self.assertIn("every run failed", err)
+
+    @patch("sys.argv")
+    def test_main_failures(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--timeout", "2.5", "--include-failed", "--max-failures", "4", "cmd"]), \
+                patch("bench.run_benchmark", return_value={"aborted": True}) as mock_run_benchmark:
+            with self.assertRaises(SystemExit) as cm:
+                bench.main()
+            self.assertEqual(cm.exception.code, 1)
+            _, kwargs = mock_run_benchmark.call_args
+            self.assertEqual(kwargs["timeout"], 2.5)
+            self.assertTrue(kwargs["include_failed"])
+            self.assertEqual(kwargs["max_failures"], 4)
+
+    IMPORTTIME_OUTPUT = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       100 |        100 |   _io\n"
+        "import time:       200 |        300 | site\n"
+        "import time:       400 |        400 |     re._parser\n"
+        "import time:      1000 |       1400 |   re\n"
+        "import time:       600 |       2000 | json\n"
+        "script warning\n"
+    )
+
+    def test_parse_importtime(self) -> None:
+        entries = bench.parse_importtime(self.IMPORTTIME_OUTPUT)
+        self.assertEqual(entries[0], ("_io", 1, 100.0, 100.0))
+        self.assertEqual(entries[1], ("site", 0, 200.0, 300.0))
+        self.assertEqual(entries[2], ("re._parser", 2, 400.0, 400.0))
+        self.assertEqual(entries[4], ("json", 0, 600.0, 2000.0))
+        self.assertEqual(len(entries), 5)
+
+    def test_run_python_imports(self) -> None:
+        result = MagicMock(stderr=self.IMPORTTIME_OUTPUT, returncode=0)
+        captured_stdout = io.StringIO()
+        captured_stderr = io.StringIO()
+        with patch("subprocess.run", return_value=result) as mock_run, \
+                patch("sys.stdout", captured_stdout), patch("sys.stderr", captured_stderr):
+            record = bench.run_python_imports(["script.py", "arg"], 3, top=2, warmup=1)
+        self.assertEqual(mock_run.call_count, 4)
+        self.assertEqual(mock_run.call_args[0][0], [sys.executable, "-X", "importtime", "script.py", "arg"])
+        self.assertEqual(record["import_total"], [0.0023] * 3)
+        self.assertEqual(len(record["wall"]), 3)
+        self.assertEqual([m["module"] for m in record["modules"][:3]], ["json", "re", "re._parser"])
+        lines = captured_stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith("json"))
+        self.assertIn("script warning", captured_stderr.getvalue())
+        self.assertNotIn("imported package", captured_stderr.getvalue())
+
+    @patch("sys.argv")
+    def test_main_python_imports(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--python-imports", "--top", "5", "-n", "3", "calc.py", "1+2"]), \
+                patch("bench.run_python_imports") as mock_run_imports:
+            bench.main()
+            mock_run_imports.assert_called_once_with(["calc.py", "1+2"], 3, top=5, no_stdout=False,
+                                                     no_stderr=False, warmup=0)
+
+    def test_parse_size(self) -> None:
+        self.assertEqual(bench.parse_size("4096"), 4096)
+        self.assertEqual(bench.parse_size("512K"), 512 * 1024)
+        self.assertEqual(bench.parse_size("10M"), 10 << 20)
+        self.assertEqual(bench.parse_size("1.5GiB"), 3 << 29)
+        for bad in ("", "abc", "-1M", "0"):
+            with self.assertRaises(ValueError):
+                bench.parse_size(bad)
+
+    def test_generate_corpus(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "corpus")
+            bench.generate_corpus(path, 10000)
+            size, lines = bench.count_lines(path)
+            self.assertEqual(size, 10000)
+            self.assertGreater(lines, 50)
+
+            source = os.path.join(tmp, "source")
+            with open(source, "wb") as f:
+                f.write(b"ab\n")
+            bench.generate_corpus(path, 10, source=source)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"ab\nab\nab\na")
+
+    def test_run_stream_once(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input")
+            bench.generate_corpus(path, 300000)
+            _, lines = bench.count_lines(path)
+            elapsed, returncode, usage = bench.run_stream_once(["cat"], path, None)
+            self.assertEqual(returncode, 0)
+            self.assertEqual(usage["out_bytes"], 300000)
+            self.assertEqual(usage["out_lines"], lines)
+            # A filter that stops reading early must not make the feeder fail.
+            _, returncode, usage = bench.run_stream_once(["head", "-1"], path, None)
+            self.assertEqual((returncode, usage["out_lines"]), (0, 1))
+
+    def test_run_stream(self) -> None:
+        captured_stdout = io.StringIO()
+        with patch("sys.stdout", captured_stdout), patch("sys.stderr", io.StringIO()):
+            record = bench.run_stream(["cat"], 2, input_size=4096)
+        self.assertEqual(len(record["samples"]), 2)
+        self.assertEqual(record["throughput"]["in_bytes"], 4096)
+        self.assertEqual(record["throughput"]["out_bytes"], 4096)
+        self.assertIn("MB/s", captured_stdout.getvalue())
+        self.assertIn("Per input line:", captured_stdout.getvalue())
+
+    def test_run_stream_zero_time(self) -> None:
+        # A median below the timer resolution gives no rate, rather than Infinity in the JSON.
+        usage = {key: 0.0 for key, _, _ in bench.RUSAGE_FIELDS}
+        usage.update(out_bytes=4096.0, out_lines=1.0, timed_out=False)
+        with tempfile.TemporaryDirectory() as tmp, patch("bench.run_stream_once", return_value=(0.0, 0, usage)), \
+                patch("sys.stdout", io.StringIO()) as captured_stdout, patch("sys.stderr", io.StringIO()):
+            record = bench.run_stream(["cat"], 2, input_size=4096)
+            path = os.path.join(tmp, "out.json")
+            bench.write_json(record, path)
+            with open(path) as f:
+                throughput = json.load(f)["throughput"]
+        self.assertEqual((throughput["in_mb_per_s"], throughput["lines_per_s"]), (None, None))
+        self.assertIn("n/a MB/s", captured_stdout.getvalue())
+        with self.assertRaises(ValueError):
+            bench.write_json({"ratio": float("inf")}, os.devnull)
+
+    @patch("sys.argv")
+    def test_main_stream(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--input-size", "1M", "-n", "4", "cmd"]), \
+                patch("bench.run_stream") as mock_run_stream:
+            bench.main()
+            mock_run_stream.assert_called_once_with(["cmd"], 4, input_path=None, input_size=1 << 20,
+                                                    no_stderr=False, warmup=0, timeout=None, verbose=False)
+        with patch("sys.argv", ["bench", "--input", "/nonexistent/file", "cmd"]), \
+                patch("sys.stderr", io.StringIO()) as captured_stderr:
+            with self.assertRaises(SystemExit):
+                bench.main()
+            self.assertIn("input file not found", captured_stderr.getvalue())
+
+    PERF_STAT_OUTPUT = """# started on Sat Jan  3 10:00:00 2026
+
+2.53,msec,task-clock:u,2530000,100.00,0.812,CPUs utilized
+1200000,,instructions:u,2530000,100.00,1.50,insn per cycle
+800000,,cpu_core/cycles/u,2530000,100.00,,
+<not supported>,,cache-misses:u,0,100.00,,
+"""
+
+    def test_parse_perf_stat(self) -> None:
+        values = bench.parse_perf_stat(self.PERF_STAT_OUTPUT)
+        self.assertEqual(set(values), {"task-clock", "instructions", "cycles"})
+        self.assertAlmostEqual(values["task-clock"], 0.00253)
+        self.assertEqual(values["cycles"], 800000.0)
+
+    def test_parse_perf_stat_hybrid(self) -> None:
+        # Each event is counted by both PMUs of a hybrid CPU.
+        values = bench.parse_perf_stat("""
+1200000,,cpu_core/instructions/u,2000000,79.00,1.50,insn per cycle
+300000,,cpu_atom/instructions/u,530000,21.00,0.90,insn per cycle
+800000,,cpu_core/cycles/u,2000000,79.00,,
+<not counted>,,cpu_atom/cycles/u,0,0.00,,
+""")
+        self.assertEqual(values, {"instructions": 1500000.0, "cycles": 800000.0})
+
+    def test_run_once_counters(self) -> None:
+        def fake_perf(argv: List[str], **kwargs: Any) -> subprocess.Popen:
+            # Stands in for perf: writes the CSV to the -o file, then runs the wrapped command.
+            with open(argv[argv.index("-o") + 1], "w") as f:
+                f.write(self.PERF_STAT_OUTPUT)
+            return real_popen(argv[argv.index("--") + 1:], **kwargs)
+        real_popen = subprocess.Popen
+        with patch("bench.subprocess.Popen", side_effect=fake_perf) as mock_popen:
+            _, returncode, usage = bench.run_once(["true"], None, None, counters=["instructions", "cycles"])
+        argv = mock_popen.call_args[0][0]
+        self.assertEqual(argv[:2], ["perf", "stat"])
+        self.assertIn("instructions,cycles", argv)
+        self.assertEqual(argv[-2:], ["--", "true"])
+        self.assertEqual(returncode, 0)
+        self.assertEqual(usage["instructions"], 1200000.0)
+        self.assertGreater(usage["maxrss"], 0)
+
+    def test_run_once_counters_timeout(self) -> None:
+        # The command runs as a grandchild under perf: a timeout must kill it too.
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_path = os.path.join(tmp, "pid")
+            script = ("import subprocess, sys; p = subprocess.Popen(['sleep', '30']); "
+                      f"open({pid_path!r}, 'w').write(str(p.pid)); p.wait()")
+            def fake_perf(argv: List[str], **kwargs: Any) -> subprocess.Popen:
+                return real_popen([sys.executable, "-c", script], **kwargs)
+            real_popen = subprocess.Popen
+            with patch("bench.subprocess.Popen", side_effect=fake_perf):
+                _, returncode, usage = bench.run_once(["sleep", "30"], None, None, timeout=0.5,
+                                                      counters=["instructions"])
+            self.assertEqual(usage["timed_out"], 1.0)
+            with open(pid_path) as f:
+                pid = int(f.read())
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    if f.read().split(")")[-1].split()[0] == "Z":
+                        break  # Killed, not yet reaped by its new parent.
+            except FileNotFoundError:
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("the command outlived the timeout")
+
+    def test_run_benchmark_counters(self) -> None:
+        counters = {"instructions": 3000.0, "cycles": 2000.0, "cache-references": 100.0, "cache-misses": 5.0}
+        record, _, mock_run_once = self.run_with_results([(0.1, 0, counters)] * 3,
+                                                         counters=list(counters))
+        self.assertEqual(mock_run_once.call_args[0][4], list(counters))
+        self.assertEqual(record["counters"]["instructions"], 3000.0)
+        self.assertAlmostEqual(record["counters"]["ipc"], 1.5)
+        self.assertAlmostEqual(record["counters"]["cache_miss_rate"], 5.0)
+
+    @patch("sys.argv")
+    def test_main_counters(self, mock_argv: MagicMock) -> None:
+        with patch("sys.argv", ["bench", "--counters", "cmd"]), patch("bench.shutil.which", return_value=None), \
+                patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit) as cm:
                 bench.main()
-                mock_run_benchmark.assert_called_once_with(
-                    ["sleep", "1"], 10, no_stdout=True, no_stderr=True
-                )
+            self.assertIn("requires the 'perf' command", str(cm.exception.code))
+        # Without hardware counters (e.g. in a VM), the software ones are used.
+        with patch("sys.argv", ["bench", "--counters", "cmd"]), \
+                patch("bench.shutil.which", return_value="/usr/bin/perf"), \
+                patch("bench.probe_counters", side_effect=[[], ["task-clock", "page-faults"]]), \
+                patch("bench.run_benchmark", return_value={"aborted": False}) as mock_run_benchmark, \
+                patch("sys.stderr", io.StringIO()) as captured_stderr:
+            bench.main()
+            self.assertEqual(mock_run_benchmark.call_args[1]["counters"], ["task-clock", "page-faults"])
+            self.assertIn("using software counters", captured_stderr.getvalue())
 
 if __name__ == "__main__":
     unittest.main()
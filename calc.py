@@ -9,20 +9,84 @@
 #
 
 import ast
+import atexit
+import contextlib
+import decimal
 from decimal import Decimal
-import fileinput
 from fractions import Fraction
+import functools
+import importlib
+import io
+import itertools
+import marshal
 import math
-import numpy as np
+import operator
+import os
 import re
 import sys
 import time
+import types
 import typing
 
+
+class LazyModule:
+    """Stands in for a module that is only imported on first attribute access, so that
+    expressions that don't use it don't pay for the import (numpy alone takes ~100ms)."""
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module: types.ModuleType | None = None
+
+    def __getattr__(self, attr: str) -> typing.Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+np = LazyModule('numpy')
+
 # Refer the following packages to prevent from getting removed
 np
 math
 
+# Number of compiled expressions kept in memory, and in the on-disk cache ($CALC_CACHE_DIR).
+COMPILE_CACHE_SIZE = 1024
+DISK_CACHE_SIZE = 4096
+
+# Bump when the transformers change, so that stale code in the on-disk cache is not reused.
+TRANSFORM_VERSION = 3
+
+# Default budgets of the safe evaluator (--safe, and always used by the server): the size of
+# integers and rationals in bits, the number of items in sequences and arrays, and seconds.
+# The size is kept below what int-to-str conversion accepts (4300 digits by default, see
+# sys.set_int_max_str_digits()), so that results within the budget can be printed.
+LOG2_10 = math.log2(10)
+_MAX_STR_DIGITS = getattr(sys, 'get_int_max_str_digits', lambda: 0)()
+MAX_INT_BITS = min(1 << 20, int((_MAX_STR_DIGITS - 1) * LOG2_10)) if _MAX_STR_DIGITS else 1 << 20
+MAX_ITEMS = 10_000_000
+EVAL_TIMEOUT = 2.0
+
+# Number of input lines evaluated at once by --map.
+MAP_CHUNK_SIZE = 65536
+
+# Input lines per chunk sent to a worker by --jobs, and chunks in flight per worker.
+PIPELINE_CHUNK_SIZE = 1000
+PIPELINE_WINDOW = 4
+
+# Seconds the calc server (--server) waits for a request before exiting, and for a client to
+# finish sending one.
+DEFAULT_SERVER_IDLE = 600
+SERVER_REQUEST_TIMEOUT = 5
+
+# Largest output of a server response, in characters.
+SERVER_MAX_OUTPUT = 1 << 20
+
+# Significant digits set with -p, used for Decimal arithmetic and the decimal rendering of fractions.
+_precision: int | None = None
+
 # Custom print wrapper to highlight the first non-comment line in bold-yellow
 _original_print = print
 _primary_printed = True
@@ -82,6 +146,29 @@ def _frac(a, b) -> Fraction:
     return a / b
 
 
+def _Q(numerator: int, denominator: int = 1) -> Fraction:
+    """Creates an exact rational number. Always a Fraction, so that results have the same
+    type and methods (e.g. limit_denominator) whatever is installed."""
+    return Fraction(numerator, denominator)
+
+
+def _rdiv(a, b):
+    """True division for fraction mode: integers stay integers while the division is exact,
+    and only become rationals when it isn't."""
+    if type(a) is int and type(b) is int:
+        if b != 0 and a % b == 0:
+            return a // b
+        return _Q(a, b)
+    return a / b
+
+
+def _pow(a, b):
+    """Power for fraction mode: an integer to a negative integer power is an exact rational."""
+    if type(a) is int and type(b) is int and b < 0:
+        return _Q(a) ** b
+    return a ** b
+
+
 def _div(a, b):
     if hasattr(a, '__array__') or hasattr(b, '__array__'):
         return a / b
@@ -93,6 +180,258 @@ def _div(a, b):
         return a / b
 
 
+# Base dimensions of quantities with units: information in bits, time in seconds, and a count
+# of operations. A unit is its scale to the base units (exact) and its exponent of each base.
+BASE_UNITS = ('bit', 's', 'op')
+DIMENSIONLESS = (0, 0, 0)
+
+SI_PREFIXES = {'k': 10**3, 'K': 10**3, 'M': 10**6, 'G': 10**9, 'T': 10**12, 'P': 10**15, 'E': 10**18}
+IEC_PREFIXES = {'Ki': 2**10, 'Mi': 2**20, 'Gi': 2**30, 'Ti': 2**40, 'Pi': 2**50, 'Ei': 2**60}
+
+# Units results are displayed in, by dimensions: ladders of units from the smallest, each
+# shown in its largest unit not above the value, and the suffix appended to each unit.
+_BYTE_LADDERS = [['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB'],
+                 ['B', 'kB', 'MB', 'GB', 'TB', 'PB', 'EB'],
+                 ['bit', 'kbit', 'Mbit', 'Gbit', 'Tbit', 'Pbit', 'Ebit']]
+_OPS_LADDERS = [['ops', 'kops', 'Mops', 'Gops', 'Tops']]
+_TIME_LADDERS = [['ns', 'us', 'ms', 's', 'min', 'h']]
+DISPLAY_LADDERS: dict[tuple[int, ...], tuple[list[list[str]], str]] = {
+    (1, 0, 0): (_BYTE_LADDERS, ''),
+    (1, -1, 0): (_BYTE_LADDERS, '/s'),
+    (1, 0, -1): (_BYTE_LADDERS, '/op'),
+    (0, 0, 1): (_OPS_LADDERS, ''),
+    (0, -1, 1): (_OPS_LADDERS, '/s'),
+    (0, 1, 0): (_TIME_LADDERS, ''),
+    (0, 1, -1): (_TIME_LADDERS, '/op'),
+    (0, -1, 0): ([['Hz', 'kHz', 'MHz', 'GHz', 'THz']], ''),
+}
+
+
+@functools.cache
+def unit_table() -> dict[str, tuple[Fraction, tuple[int, int, int]]]:
+    """Returns the known units by name, as (scale, dimensions). Built on first use."""
+    bit, second, op = (1, 0, 0), (0, 1, 0), (0, 0, 1)
+    table = {
+        'bit': (Fraction(1), bit), 'B': (Fraction(8), bit),
+        'ns': (Fraction(1, 10**9), second), 'us': (Fraction(1, 10**6), second),
+        'µs': (Fraction(1, 10**6), second), 'ms': (Fraction(1, 10**3), second),
+        's': (Fraction(1), second), 'sec': (Fraction(1), second), 'min': (Fraction(60), second),
+        'h': (Fraction(3600), second), 'day': (Fraction(86400), second),
+        'op': (Fraction(1), op), 'ops': (Fraction(1), op), 'Hz': (Fraction(1), (0, -1, 0)),
+    }
+    for prefix, scale in SI_PREFIXES.items():
+        table[f'{prefix}B'] = (Fraction(8 * scale), bit)
+        table[f'{prefix}bit'] = table[f'{prefix}b'] = (Fraction(scale), bit)
+        table[f'{prefix}ops'] = (Fraction(scale), op)
+        table[f'{prefix}Hz'] = (Fraction(scale), (0, -1, 0))
+    for prefix, scale in IEC_PREFIXES.items():
+        table[f'{prefix}B'] = (Fraction(8 * scale), bit)
+        table[f'{prefix}bit'] = (Fraction(scale), bit)
+    return table
+
+
+@functools.cache
+def unit_pattern() -> str:
+    """Returns a regex matching a unit, or a ratio of units (e.g. 'MB/s')."""
+    names = '|'.join(re.escape(name) for name in sorted(unit_table(), key=len, reverse=True))
+    return f'(?:{names})(?:/(?:{names}))?(?![\\w(])'
+
+
+@functools.lru_cache(maxsize=256)
+def parse_unit(unit: str) -> tuple[Fraction, tuple[int, int, int]]:
+    """Returns the scale and dimensions of a unit, or a ratio of units (e.g. 'MB/s')."""
+    table = unit_table()
+    numerator, _, denominator = unit.partition('/')
+    try:
+        scale, dims = table[numerator]
+        if denominator:
+            den_scale, den_dims = table[denominator]
+            scale, dims = scale / den_scale, tuple(a - b for a, b in zip(dims, den_dims))
+    except KeyError:
+        raise ValueError(f'unknown unit: {unit}') from None
+    return scale, dims
+
+
+def _exact(value: typing.Any) -> Fraction | int:
+    """Converts a number to an exact int or Fraction (floats by their shortest repr)."""
+    if isinstance(value, (int, Fraction)):
+        return value
+    if isinstance(value, float):
+        return Fraction(str(value))
+    if isinstance(value, Decimal):
+        return Fraction(value)
+    numerator = getattr(value, 'numerator', None)
+    denominator = getattr(value, 'denominator', None)
+    if numerator is None or denominator is None:
+        raise TypeError(f'unsupported operand for units: {type(value).__name__}')
+    return Fraction(int(numerator), int(denominator))
+
+
+def format_scalar(value: Fraction | int) -> str:
+    """Renders an exact value: integers exactly, others with 10 significant digits."""
+    if value == int(value):
+        return str(int(value))
+    return f'{float(value):.10g}'
+
+
+class Quantity:
+    """A number with a unit, e.g. 512MiB or 10Gbit/s. The value is kept exactly in base units
+    (see BASE_UNITS); `unit` is the unit to display it in, if converted with `in`."""
+    __slots__ = ('value', 'dims', 'unit')
+
+    def __init__(self, value: Fraction | int, dims: tuple[int, ...], unit: str | None = None) -> None:
+        self.value = value
+        self.dims = dims
+        self.unit = unit
+
+    @staticmethod
+    def make(value: Fraction | int, dims: tuple[int, ...]) -> typing.Any:
+        """Returns a Quantity, or the plain number if the units cancel out."""
+        if dims == DIMENSIONLESS:
+            return value.numerator if value.denominator == 1 else value
+        return Quantity(value, dims)
+
+    @staticmethod
+    def split(other: typing.Any) -> tuple[Fraction | int, tuple[int, ...]]:
+        if isinstance(other, Quantity):
+            return other.value, other.dims
+        return _exact(other), DIMENSIONLESS
+
+    def convert(self, unit: str) -> 'Quantity':
+        scale, dims = parse_unit(unit)
+        if dims != self.dims:
+            raise ValueError(f'cannot convert {self.base_unit()} to {unit}')
+        return Quantity(self.value, self.dims, unit)
+
+    def in_unit(self, unit: str) -> str:
+        return f'{format_scalar(self.value / parse_unit(unit)[0])} {unit}'
+
+    def base_unit(self) -> str:
+        num = [name if n == 1 else f'{name}^{n}' for name, n in zip(BASE_UNITS, self.dims) if n > 0]
+        den = [name if n == -1 else f'{name}^{-n}' for name, n in zip(BASE_UNITS, self.dims) if n < 0]
+        return '*'.join(num or ['1']) + ''.join(f'/{name}' for name in den)
+
+    def renderings(self) -> list[str]:
+        """Returns the value in the unit converted to with `in`, else in the best fitting unit
+        of each ladder of DISPLAY_LADDERS (e.g. in MiB, MB and Mbit), or in base units."""
+        if self.unit is not None:
+            return [self.in_unit(self.unit)]
+        ladders, suffix = DISPLAY_LADDERS.get(self.dims, ([], ''))
+        renderings = []
+        for ladder in ladders:
+            best = ladder[0] + suffix
+            for name in ladder[1:]:
+                if abs(self.value) >= parse_unit(name + suffix)[0]:
+                    best = name + suffix
+            renderings.append(self.in_unit(best))
+        return renderings or [f'{format_scalar(self.value)} {self.base_unit()}']
+
+    def __str__(self) -> str:
+        return self.renderings()[0]
+
+    def __repr__(self) -> str:
+        return f'Quantity({self})'
+
+    def __add__(self, other: typing.Any) -> typing.Any:
+        if not isinstance(other, Quantity) and other == 0:
+            return self  # sum() starts from 0.
+        value, dims = Quantity.split(other)
+        if dims != self.dims:
+            raise TypeError(f'incompatible units: {self.base_unit()} and {Quantity(value, dims).base_unit()}')
+        return Quantity.make(self.value + value, dims)
+
+    __radd__ = __add__
+
+    def __sub__(self, other: typing.Any) -> typing.Any:
+        return self + -other
+
+    def __rsub__(self, other: typing.Any) -> typing.Any:
+        return -self + other
+
+    def __neg__(self) -> 'Quantity':
+        return Quantity(-self.value, self.dims)
+
+    def __pos__(self) -> 'Quantity':
+        return self
+
+    def __abs__(self) -> 'Quantity':
+        return Quantity(abs(self.value), self.dims)
+
+    def __mul__(self, other: typing.Any) -> typing.Any:
+        value, dims = Quantity.split(other)
+        return Quantity.make(self.value * value, tuple(a + b for a, b in zip(self.dims, dims)))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other: typing.Any) -> typing.Any:
+        value, dims = Quantity.split(other)
+        return Quantity.make(Fraction(self.value) / value, tuple(a - b for a, b in zip(self.dims, dims)))
+
+    def __rtruediv__(self, other: typing.Any) -> typing.Any:
+        value, dims = Quantity.split(other)
+        return Quantity.make(value / Fraction(self.value), tuple(b - a for a, b in zip(self.dims, dims)))
+
+    def __pow__(self, exponent: typing.Any) -> typing.Any:
+        if not isinstance(exponent, int):
+            raise TypeError('units can only be raised to integer powers')
+        return Quantity.make(Fraction(self.value) ** exponent, tuple(a * exponent for a in self.dims))
+
+    def __eq__(self, other: typing.Any) -> bool:
+        try:
+            value, dims = Quantity.split(other)
+        except TypeError:
+            return NotImplemented
+        return dims == self.dims and self.value == value
+
+    def __hash__(self) -> int:
+        return hash((self.value, self.dims))
+
+    def _compare(self, other: typing.Any, op: typing.Callable[[typing.Any, typing.Any], bool]) -> bool:
+        value, dims = Quantity.split(other)
+        if dims != self.dims:
+            raise TypeError(f'incompatible units: {self.base_unit()} and {Quantity(value, dims).base_unit()}')
+        return op(self.value, value)
+
+    def __lt__(self, other: typing.Any) -> bool:
+        return self._compare(other, operator.lt)
+
+    def __le__(self, other: typing.Any) -> bool:
+        return self._compare(other, operator.le)
+
+    def __gt__(self, other: typing.Any) -> bool:
+        return self._compare(other, operator.gt)
+
+    def __ge__(self, other: typing.Any) -> bool:
+        return self._compare(other, operator.ge)
+
+
+def _unit(value: typing.Any, unit: str) -> Quantity:
+    """Creates the quantity of a unit literal (e.g. 512MiB, 3ms, 10Gbit/s)."""
+    scale, dims = parse_unit(unit)
+    return Quantity(_exact(value) * scale, dims)
+
+
+def _convert(value: typing.Any, unit: str) -> Quantity:
+    """Implements `expression in unit` (e.g. 10Gbit/s in MB/s)."""
+    if not isinstance(value, Quantity):
+        raise TypeError(f'cannot convert a number without a unit to {unit}')
+    return value.convert(unit)
+
+
+def replace_units(exp: str) -> str:
+    """Rewrites unit literals into calls creating quantities ('3ms' -> "_unit(3, 'ms')"), and a
+    trailing 'in UNIT' into a conversion. Expressions with no letter after a digit are
+    returned as is, without building the unit table."""
+    if not re.search(r'\d\s*[^\W\d_]', exp):
+        return exp
+    pattern = unit_pattern()
+    match = re.fullmatch(f'(.*\\S)\\s+in\\s+({pattern})\\s*', exp, re.DOTALL)
+    if match:
+        exp = f"_convert(({match.group(1)}), '{match.group(2)}')"
+    number = r'(?<![\w.])((?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+    return re.sub(f'{number}\\s*({pattern})', r"_unit(\1, '\2')", exp)
+
+
 class DecimalTransformer(ast.NodeTransformer):
     """AST transformer that converts float numeric literals into BigDecimal calls
     and converts true division (/) into a custom division function."""
@@ -138,8 +477,34 @@ Options:
   -h, --help         Show this help message and exit.
   -f, --fraction     Evaluate the expression using Fractions (default).
   -n, --no-fraction  Evaluate the expression using decimals (disables Fraction mode).
-  -i, --interactive  Run in interactive REPL mode.
+  -i, --interactive  Run in interactive REPL mode. The REPL supports variables (a = 3/7),
+                     functions (f(n) = n^2 + a), previous results (_, _1, _2, ...),
+                     ':recalc' to update results that depend on a changed variable,
+                     and ':vars' to list them.
   -t, --test         Run the test suite (calc_test.py) and exit.
+  --map EXPR         Evaluate EXPR for each number x read from the input files or stdin,
+                     one result per line (vectorized with numpy when installed).
+  -p, --precision N  Use N significant digits for decimals (-n) and for the decimal
+                     rendering of fractions (default: 28 for decimals, float for fractions).
+  --format FORMAT    Print only one representation: dec, hex, bin, i32, u64, time
+                     (GMT, as millis since epoch), or json for all of them as one
+                     JSON object per line.
+  --safe             Evaluate without eval(): only arithmetic, whitelisted functions
+                     (math, np, time and a few builtins), with limits on number sizes,
+                     array sizes and time. The server always evaluates this way.
+  --jobs N           Evaluate the lines of the input files or stdin on N processes.
+                     Results keep the input order; errors are reported inline.
+  --stats            Read one number per line from the input files or stdin, and print
+                     count, sum, mean, stddev, min, percentiles (estimated) and max,
+                     and a histogram by powers of two. Uses constant memory.
+                     NaNs and infinities are only counted, as 'non-finite'.
+  --server           Serve evaluations on a per-user Unix socket for calc-client,
+                     which spawns the server on first use.
+
+Environment:
+  CALC_CACHE_DIR     Persist compiled expressions in this directory across runs.
+  CALC_SOCKET        Socket of the server (default: $XDG_RUNTIME_DIR/calc-<uid>.sock).
+  CALC_SERVER_IDLE   Seconds of inactivity after which the server exits (default: 600).
 
 Examples:
   calc.py 1 + 2
@@ -150,25 +515,42 @@ Examples:
   calc.py "1/3 + 1/6"                         # Fraction evaluation (default)
   calc.py "1 @ 3 + 1 @ 6"                     # '@' is dedicated fraction division
   calc.py -n "0.1 + 0.2"                      # Evaluate as float/decimal
+  calc.py -p 50 "1/7"                         # 1/7 and its first 50 digits
   calc.py "Fraction(1, 3) + Fraction(1, 6)"
   calc.py 0.25
+  calc.py "512MiB / 3ms"                      # Units: B, bit (k, M, Ki, Mi, ... prefixes),
+                                              # ns, us, ms, s, min, h, day, ops, Hz
+  calc.py "10Gbit/s in MB/s"                  # Convert to a unit
+  calc.py --map 'x*1.5+3' < values.txt       # One result per input line
+  calc.py --format hex 255                    # 0xff
+  calc.py --jobs 8 --format dec < exprs.txt   # One result per line, on 8 cores
+  calc.py --stats < latencies.txt             # Aggregates and histogram of the numbers
+  calc-client "2^32 - 1"                      # Same output, evaluated by a warm server
 """)
 
 
 class FractionTransformer(ast.NodeTransformer):
-    """AST transformer that converts numeric literals (integers and floats)
-    into Fraction calls so that expressions evaluate with exact fractions."""
+    """AST transformer that converts float literals into exact rationals, and division and
+    powers into functions that keep integers exact, so that expressions evaluate with exact
+    fractions. Integer literals stay ints, which are much faster than Fractions."""
     def visit_Constant(self, node: ast.Constant) -> ast.AST:
-        if isinstance(node.value, (int, float)):
+        if isinstance(node.value, float):
+            value = Fraction(str(node.value))
             return ast.Call(
-                func=ast.Name(id='Fraction', ctx=ast.Load()),
-                args=[ast.Constant(value=str(node.value))],
+                func=ast.Name(id='_Q', ctx=ast.Load()),
+                args=[ast.Constant(value=value.numerator), ast.Constant(value=value.denominator)],
                 keywords=[]
             )
         return node
 
     def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
         self.generic_visit(node)
+        if isinstance(node.op, (ast.Div, ast.Pow)):
+            return ast.Call(
+                func=ast.Name(id='_rdiv' if isinstance(node.op, ast.Div) else '_pow', ctx=ast.Load()),
+                args=[node.left, node.right],
+                keywords=[]
+            )
         if isinstance(node.op, ast.MatMult):
             return ast.Call(
                 func=ast.Name(id='_frac', ctx=ast.Load()),
@@ -184,12 +566,584 @@ def preprocess_expression(exp: str) -> str:
     - Strips commas and underscores between digits (e.g. '100,000' -> '100000', '100_000' -> '100000')
     - Replaces '^' with '**' to treat it as the power operator (e.g. '2^3' -> '2**3')
     - Ignores leading zeros in numbers to prevent python syntax errors (e.g. '07' -> '7')
+    - Turns unit literals into quantities (e.g. '512MiB / 3ms', '10Gbit/s in MB/s', see replace_units())
     """
     exp = re.sub(r'\bx\b|(?<!\b0)(?<=\d)\s*x\s*(?=\d|\(|[a-zA-Z_])', '*', exp)
     exp = re.sub(r'(?<=\d)[,_](?=\d)', '', exp)
     exp = exp.replace('^', '**')
     exp = re.sub(r'(?<!\.)\b0+([0-9]+)', r'\1', exp)
-    return exp
+    return replace_units(exp)
+
+
+def transform_expression(exp: str, use_fraction: bool) -> ast.Expression:
+    """Preprocesses and parses a raw expression, and applies the transformer of the mode."""
+    tree = ast.parse(preprocess_expression(exp), mode='eval')
+    transformer = FractionTransformer() if use_fraction else DecimalTransformer()
+    new_tree = transformer.visit(tree)
+    ast.fix_missing_locations(new_tree)
+    return new_tree
+
+
+class CodeCache:
+    """On-disk cache of compiled expressions keyed by (mode, raw expression).
+    Code objects are only valid for the Python version that created them, so each version
+    gets its own file."""
+    def __init__(self, directory: str) -> None:
+        self.path = os.path.join(directory,
+                                 f'compiled-{sys.implementation.cache_tag}-v{TRANSFORM_VERSION}.marshal')
+        self.entries: dict[tuple[str, str], types.CodeType] | None = None
+        self.dirty = False
+
+    def load(self) -> dict[tuple[str, str], types.CodeType]:
+        if self.entries is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    entries = marshal.load(f)
+                self.entries = entries if isinstance(entries, dict) else {}
+            except (OSError, EOFError, ValueError, TypeError):
+                self.entries = {}
+        return self.entries
+
+    def get(self, key: tuple[str, str]) -> types.CodeType | None:
+        return self.load().get(key)
+
+    def put(self, key: tuple[str, str], code: types.CodeType) -> None:
+        entries = self.load()
+        entries[key] = code
+        while len(entries) > DISK_CACHE_SIZE:
+            del entries[next(iter(entries))]
+        self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty or self.entries is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f'calc.py: cannot write {self.path}: {e}', file=sys.stderr)
+
+
+_disk_cache: CodeCache | None = None
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_expression(exp: str, use_fraction: bool) -> types.CodeType:
+    """Compiles a raw expression (see transform_expression()).
+    Results are cached by (mode, raw expression), in memory and in the on-disk cache if enabled."""
+    key = ('fraction' if use_fraction else 'decimal', exp)
+    if _disk_cache is not None:
+        code = _disk_cache.get(key)
+        if code is not None:
+            return code
+
+    code = compile(transform_expression(exp, use_fraction), '<string>', 'eval')
+
+    if _disk_cache is not None:
+        _disk_cache.put(key, code)
+    return code
+
+
+def enable_disk_cache(directory: str) -> None:
+    """Persists compiled expressions under `directory`, written back at exit."""
+    global _disk_cache
+    _disk_cache = CodeCache(directory)
+    compile_expression.cache_clear()
+    atexit.register(_disk_cache.save)
+
+
+def evaluate(exp: str, use_fraction: bool, globals_dict: dict[str, typing.Any],
+             budget: 'Budget | None' = None) -> typing.Any:
+    """Evaluates a raw (not yet preprocessed) expression. With a budget, the expression is
+    evaluated by the safe evaluator instead of eval()."""
+    if budget is not None:
+        node = compile_safe_expression(exp, use_fraction)
+        with budget.start().alarm():
+            return node(budget, {})
+    return eval(compile_expression(exp, use_fraction), globals_dict)
+
+
+class LimitExceeded(Exception):
+    """Raised when a safe evaluation exceeds one of its budgets."""
+
+
+class Budget:
+    """Resource limits of a safe evaluation: the size of integers and rationals in bits, the
+    number of items in the sequences and arrays created by the whole evaluation, and the
+    wall-clock time."""
+    def __init__(self, max_int_bits: int = MAX_INT_BITS, max_items: int = MAX_ITEMS,
+                 timeout: float = EVAL_TIMEOUT) -> None:
+        self.max_int_bits = max_int_bits
+        self.max_items = max_items
+        self.timeout = timeout
+        self.deadline = math.inf
+        self.items = 0
+        self.alarm_set = False
+
+    def start(self) -> 'Budget':
+        self.deadline = time.monotonic() + self.timeout
+        self.items = 0
+        return self
+
+    @contextlib.contextmanager
+    def alarm(self) -> typing.Iterator[None]:
+        """Interrupts the evaluation with SIGALRM at the deadline, as a backstop for the time
+        spent where tick() isn't called. Signals are only handled in the main thread, and
+        between bytecodes: a single long C call still runs to its end."""
+        import signal
+        if self.alarm_set or not hasattr(signal, 'setitimer') or self.deadline == math.inf:
+            yield
+            return
+
+        def expired(signum: int, frame: typing.Any) -> None:
+            raise LimitExceeded(f'evaluation took longer than {self.timeout:g}s')
+
+        try:
+            previous = signal.signal(signal.SIGALRM, expired)
+        except ValueError:
+            yield  # Not the main thread.
+            return
+        self.alarm_set = True
+        try:
+            signal.setitimer(signal.ITIMER_REAL, max(self.deadline - time.monotonic(), 0.001))
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            self.alarm_set = False
+
+    def tick(self) -> None:
+        if time.monotonic() > self.deadline:
+            raise LimitExceeded(f'evaluation took longer than {self.timeout:g}s')
+
+    def check_bits(self, bits: float) -> None:
+        if bits > self.max_int_bits:
+            raise LimitExceeded(f'number of ~{int(bits)} bits exceeds the limit of {self.max_int_bits} bits')
+
+    def check_items(self, count: int) -> None:
+        if count > self.max_items:
+            raise LimitExceeded(f'{count} items exceed the limit of {self.max_items}')
+
+    def charge_items(self, count: int) -> None:
+        """Counts items created by the evaluation, so that many containers (e.g. nested in a
+        list) can't add up to more than the limit either."""
+        self.items += count
+        if self.items > self.max_items:
+            raise LimitExceeded(f'{self.items} items created in total exceed the limit of {self.max_items}')
+
+    def check(self, value: typing.Any) -> typing.Any:
+        """Checks the size of a (intermediate) result and returns it. Sequences and arrays are
+        charged to the items created by the evaluation (ranges are not, as they are lazy)."""
+        bits = _magnitude_bits(value)
+        if bits is not None:
+            self.check_bits(bits)
+        elif isinstance(value, range):
+            self.check_items(len(value))
+        elif isinstance(value, (str, bytes, list, tuple)):
+            self.charge_items(len(value))
+        elif hasattr(value, '__array__') and isinstance(getattr(value, 'size', None), int):
+            self.charge_items(value.size)
+        return value
+
+
+def _magnitude_bits(value: typing.Any) -> float | None:
+    """Returns the approximate size in bits of an int, rational or Decimal, or None for other values."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, Quantity):
+        return _magnitude_bits(value.value)
+    if isinstance(value, int):
+        return value.bit_length()
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return None
+        sign, digits, exponent = value.as_tuple()
+        return (len(digits) + abs(exponent)) * LOG2_10
+    numerator = getattr(value, 'numerator', None)
+    denominator = getattr(value, 'denominator', None)
+    if numerator is not None and denominator is not None:
+        return max(int(numerator).bit_length(), int(denominator).bit_length())
+    return None
+
+
+def _log2_magnitude(value: typing.Any) -> float | None:
+    """Returns log2 of the larger of |numerator| and denominator of an int or rational."""
+    if isinstance(value, Quantity):
+        value = value.value
+    bits = _magnitude_bits(value)
+    if bits is None or isinstance(value, Decimal):
+        return None
+    if isinstance(value, int):
+        return math.log2(abs(value)) if value else 0.0
+    return max(math.log2(abs(int(value.numerator)) or 1), math.log2(int(value.denominator)))
+
+
+def _guard_pow(budget: Budget, args: tuple, kwargs: dict) -> None:
+    if len(args) != 2:
+        return  # pow(base, exp, mod) is bounded by mod.
+    base, exponent = args
+    log2_base = _log2_magnitude(base)
+    if log2_base is None or isinstance(exponent, bool):
+        return
+    if isinstance(exponent, Fraction) and exponent.denominator == 1:
+        exponent = exponent.numerator
+    if isinstance(exponent, int):
+        budget.check_bits(log2_base * abs(exponent))
+
+
+def _guard_lshift(budget: Budget, args: tuple, kwargs: dict) -> None:
+    value, shift = args
+    if isinstance(value, int) and isinstance(shift, int):
+        budget.check_bits(value.bit_length() + shift)
+
+
+def _guard_repeat(budget: Budget, args: tuple, kwargs: dict) -> None:
+    for seq, count in (args, args[::-1]):
+        if isinstance(seq, (str, bytes, list, tuple)) and isinstance(count, int):
+            budget.check_items(budget.items + len(seq) * count)
+
+
+def _guard_factorial(budget: Budget, args: tuple, kwargs: dict) -> None:
+    n = args[0] if args else 0
+    if isinstance(n, int) and n > 2:
+        budget.check_bits(n * math.log2(n))
+
+
+def _guard_comb(budget: Budget, args: tuple, kwargs: dict) -> None:
+    # comb(n, k) and perm(n, k) are at most n ** k.
+    n = args[0] if args else 0
+    k = args[1] if len(args) > 1 and args[1] is not None else n
+    if isinstance(n, int) and isinstance(k, int) and n > 2:
+        budget.check_bits(min(k, n) * math.log2(n))
+
+
+def _guard_rational(budget: Budget, args: tuple, kwargs: dict) -> None:
+    # Fraction('1e-999999999') and Fraction(Decimal) expand the decimal exponent.
+    for arg in args:
+        if isinstance(arg, str):
+            exponent = re.search(r'[eE]\s*([+-]?\d+)', arg)
+            if exponent:
+                budget.check_bits((len(arg) + abs(int(exponent.group(1)))) * LOG2_10)
+        else:
+            bits = _magnitude_bits(arg)
+            if bits is not None:
+                budget.check_bits(bits)
+
+
+def _checked_items(budget: Budget, iterable: typing.Iterable[typing.Any], product: bool) -> typing.Iterator[typing.Any]:
+    """Yields the items of an aggregation (sum, prod), checking the time and a bound of the
+    size of the aggregate on each item, since the aggregation itself runs in C."""
+    total_bits = max_int_bits = 0.0
+    items = 0
+    for count, item in enumerate(iterable, 1):
+        budget.tick()
+        bits = _magnitude_bits(item)
+        if bits is not None:
+            # A sum of ints grows by a bit per doubling of the count, but rationals and
+            # products can grow by the size of each item.
+            if product or not isinstance(item, int):
+                total_bits += bits
+            else:
+                max_int_bits = max(max_int_bits, bits)
+            budget.check_bits(total_bits + max_int_bits + math.log2(count))
+        elif isinstance(item, (str, bytes, list, tuple)):
+            items += len(item)
+            budget.check_items(items)
+        yield item
+
+
+def _guard_sum(budget: Budget, args: tuple, kwargs: dict) -> tuple:
+    return (_checked_items(budget, args[0], False),) + args[1:] if args else args
+
+
+def _guard_prod(budget: Budget, args: tuple, kwargs: dict) -> tuple:
+    return (_checked_items(budget, args[0], True),) + args[1:] if args else args
+
+
+def _guard_range(budget: Budget, args: tuple, kwargs: dict) -> None:
+    budget.check_items(len(range(*args)))
+
+
+def _guard_shape(budget: Budget, args: tuple, kwargs: dict) -> None:
+    shape = args[0] if args else kwargs.get('shape', 0)
+    budget.check_items(math.prod(shape) if isinstance(shape, (tuple, list)) else shape)
+
+
+def _guard_arange(budget: Budget, args: tuple, kwargs: dict) -> None:
+    start, stop, step = (0, args[0], 1) if len(args) == 1 else (tuple(args) + (1,))[:3]
+    if step:
+        budget.check_items(max(0, math.ceil((stop - start) / step)))
+
+
+def _guard_linspace(budget: Budget, args: tuple, kwargs: dict) -> None:
+    budget.check_items(args[2] if len(args) > 2 else kwargs.get('num', 50))
+
+
+def _guard_eye(budget: Budget, args: tuple, kwargs: dict) -> None:
+    n = args[0] if args else kwargs.get('N', 0)
+    m = args[1] if len(args) > 1 and args[1] is not None else kwargs.get('M') or n
+    budget.check_items(n * m)
+
+
+# Names available to safe expressions, besides the math, np and time namespaces.
+SAFE_BUILTINS = ['abs', 'all', 'any', 'bin', 'bool', 'divmod', 'enumerate', 'float', 'hex', 'int',
+                 'len', 'list', 'max', 'min', 'oct', 'pow', 'range', 'round', 'sorted', 'sum', 'tuple',
+                 'zip']
+SAFE_NAMESPACES = {
+    'math': [name for name in dir(math) if not name.startswith('_')],
+    'np': ['pi', 'e', 'inf', 'nan', 'abs', 'absolute', 'sqrt', 'cbrt', 'exp', 'exp2', 'expm1', 'log',
+           'log2', 'log10', 'log1p', 'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2',
+           'sinh', 'cosh', 'tanh', 'degrees', 'radians', 'hypot', 'floor', 'ceil', 'round', 'rint',
+           'trunc', 'sign', 'mod', 'minimum', 'maximum', 'clip', 'sum', 'prod', 'mean', 'median',
+           'std', 'var', 'min', 'max', 'cumsum', 'cumprod', 'sort', 'argmin', 'argmax', 'percentile',
+           'array', 'asarray', 'arange', 'linspace', 'ones', 'zeros', 'full', 'eye', 'identity'],
+    'time': ['time', 'time_ns', 'monotonic', 'gmtime', 'localtime', 'mktime'],
+}
+# Attributes and methods that may be used on values.
+SAFE_ATTRIBUTES = {'numerator', 'denominator', 'real', 'imag', 'shape', 'size', 'ndim', 'T',
+                   'limit_denominator', 'bit_length', 'as_integer_ratio', 'conjugate', 'is_integer',
+                   'sqrt', 'ln', 'log10', 'exp', 'sum', 'mean', 'min', 'max', 'tolist'}
+# Checks run before calling functions whose cost or result size depends on their arguments.
+# A check may also return replacement arguments, e.g. to check the items of an iterable as
+# they are consumed.
+SAFE_GUARDS: dict[str, typing.Callable[[Budget, tuple, dict], tuple | None]] = {
+    'pow': _guard_pow, '_pow': _guard_pow, 'range': _guard_range,
+    'sum': _guard_sum, 'math.prod': _guard_prod,
+    'Fraction': _guard_rational, 'F': _guard_rational, '_frac': _guard_rational,
+    'math.factorial': _guard_factorial, 'math.comb': _guard_comb, 'math.perm': _guard_comb,
+    'np.ones': _guard_shape, 'np.zeros': _guard_shape, 'np.full': _guard_shape,
+    'np.arange': _guard_arange, 'np.linspace': _guard_linspace, 'np.eye': _guard_eye,
+    'np.identity': _guard_eye,
+}
+
+_BINARY_OPERATORS: dict[type, typing.Callable[[typing.Any, typing.Any], typing.Any]] = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift, ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor, ast.BitAnd: operator.and_, ast.MatMult: _frac,
+}
+_BINARY_GUARDS = {ast.Pow: _guard_pow, ast.LShift: _guard_lshift, ast.Mult: _guard_repeat}
+_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Invert: operator.invert,
+                    ast.Not: operator.not_}
+_COMPARISONS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b,
+                ast.NotIn: lambda a, b: a not in b}
+
+# A compiled node: called with the budget and the variables in scope (REPL and comprehension variables).
+_Node = typing.Callable[[Budget, dict[str, typing.Any]], typing.Any]
+
+
+class SafeCompiler:
+    """Compiles a transformed expression tree into nested closures that evaluate it without
+    eval(). Only whitelisted syntax, names and attributes are accepted, and every operation is
+    checked against a Budget, so that untrusted input can't run arbitrary code, hang or
+    exhaust memory (the time limit is checked between operations and on each item consumed by
+    aggregations, with SIGALRM as a backstop, and operations that could run long on their own
+    are checked beforehand)."""
+    def __init__(self, names: dict[str, typing.Any]) -> None:
+        self.names = names
+        self.local_names: set[str] = set()
+
+    def compile(self, node: ast.AST) -> _Node:
+        method = getattr(self, 'compile_' + type(node).__name__, None)
+        if method is None:
+            raise ValueError(f'{type(node).__name__} is not allowed in safe mode')
+        return method(node)
+
+    def compile_Expression(self, node: ast.Expression) -> _Node:
+        return self.compile(node.body)
+
+    def compile_Constant(self, node: ast.Constant) -> _Node:
+        value = node.value
+        return lambda budget, env: value
+
+    def compile_Name(self, node: ast.Name) -> _Node:
+        name = node.id
+        if name in self.local_names:
+            return lambda budget, env: env[name]
+        if name not in self.names:
+            # A variable of the REPL session, passed in the environment.
+            def lookup(budget: Budget, env: dict[str, typing.Any]) -> typing.Any:
+                try:
+                    return env[name]
+                except KeyError:
+                    raise NameError(f"name '{name}' is not defined") from None
+            return lookup
+        value = self.names[name]
+        return lambda budget, env: value
+
+    def compile_Attribute(self, node: ast.Attribute) -> _Node:
+        attr = node.attr
+        if isinstance(node.value, ast.Name) and node.value.id in SAFE_NAMESPACES \
+                and node.value.id not in self.local_names:
+            if attr not in SAFE_NAMESPACES[node.value.id]:
+                raise ValueError(f"'{node.value.id}.{attr}' is not allowed in safe mode")
+            module = self.names[node.value.id]
+            # Looked up on each evaluation, so that lazily loaded modules stay lazy.
+            return lambda budget, env: getattr(module, attr)
+        if attr not in SAFE_ATTRIBUTES:
+            raise ValueError(f"attribute '{attr}' is not allowed in safe mode")
+        value = self.compile(node.value)
+        return lambda budget, env: getattr(value(budget, env), attr)
+
+    def compile_BinOp(self, node: ast.BinOp) -> _Node:
+        op = _BINARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise ValueError(f'{type(node.op).__name__} is not allowed in safe mode')
+        guard = _BINARY_GUARDS.get(type(node.op))
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+        def binop(budget: Budget, env: dict[str, typing.Any]) -> typing.Any:
+            a = left(budget, env)
+            b = right(budget, env)
+            budget.tick()
+            if guard is not None:
+                guard(budget, (a, b), {})
+            return budget.check(op(a, b))
+        return binop
+
+    def compile_UnaryOp(self, node: ast.UnaryOp) -> _Node:
+        op = _UNARY_OPERATORS[type(node.op)]
+        operand = self.compile(node.operand)
+        return lambda budget, env: op(operand(budget, env))
+
+    def compile_BoolOp(self, node: ast.BoolOp) -> _Node:
+        values = [self.compile(value) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+        def boolop(budget: Budget, env: dict[str, typing.Any]) -> typing.Any:
+            for value in values:
+                result = value(budget, env)
+                if bool(result) != is_and:
+                    return result
+            return result
+        return boolop
+
+    def compile_Compare(self, node: ast.Compare) -> _Node:
+        left = self.compile(node.left)
+        ops = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in _COMPARISONS:
+                raise ValueError(f'{type(op).__name__} is not allowed in safe mode')
+            ops.append((_COMPARISONS[type(op)], self.compile(comparator)))
+        def compare(budget: Budget, env: dict[str, typing.Any]) -> typing.Any:
+            a = left(budget, env)
+            for op, comparator in ops:
+                b = comparator(budget, env)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return compare
+
+    def compile_IfExp(self, node: ast.IfExp) -> _Node:
+        test, body, orelse = self.compile(node.test), self.compile(node.body), self.compile(node.orelse)
+        return lambda budget, env: body(budget, env) if test(budget, env) else orelse(budget, env)
+
+    def compile_Tuple(self, node: ast.Tuple) -> _Node:
+        items = [self.compile(item) for item in node.elts]
+        return lambda budget, env: tuple(item(budget, env) for item in items)
+
+    def compile_List(self, node: ast.List) -> _Node:
+        items = [self.compile(item) for item in node.elts]
+        return lambda budget, env: [item(budget, env) for item in items]
+
+    def compile_Subscript(self, node: ast.Subscript) -> _Node:
+        value, index = self.compile(node.value), self.compile(node.slice)
+        return lambda budget, env: value(budget, env)[index(budget, env)]
+
+    def compile_Slice(self, node: ast.Slice) -> _Node:
+        parts = [self.compile(part) if part is not None else None
+                 for part in (node.lower, node.upper, node.step)]
+        return lambda budget, env: slice(*(part(budget, env) if part else None for part in parts))
+
+    def compile_Call(self, node: ast.Call) -> _Node:
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+            raise ValueError('argument unpacking is not allowed in safe mode')
+        func = self.compile(node.func)
+        args = [self.compile(arg) for arg in node.args]
+        keywords = [(kw.arg, self.compile(kw.value)) for kw in node.keywords]
+        guard = SAFE_GUARDS.get(self.qualified_name(node.func))
+        def call(budget: Budget, env: dict[str, typing.Any]) -> typing.Any:
+            f = func(budget, env)
+            a = tuple(arg(budget, env) for arg in args)
+            kw = {name: value(budget, env) for name, value in keywords}
+            budget.tick()
+            if guard is not None:
+                a = guard(budget, a, kw) or a
+            return budget.check(f(*a, **kw))
+        return call
+
+    def qualified_name(self, node: ast.AST) -> str | None:
+        """Returns 'name' or 'namespace.name' for a function of the whitelist."""
+        if isinstance(node, ast.Name) and node.id not in self.local_names:
+            return node.id
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+                and node.value.id in SAFE_NAMESPACES and node.value.id not in self.local_names:
+            return f'{node.value.id}.{node.attr}'
+        return None
+
+    def compile_comprehension(self, node: ast.GeneratorExp | ast.ListComp) -> _Node:
+        saved = set(self.local_names)
+        loops = []
+        for generator in node.generators:
+            if generator.is_async:
+                raise ValueError('async comprehensions are not allowed in safe mode')
+            iterable = self.compile(generator.iter)
+            targets = generator.target.elts if isinstance(generator.target, ast.Tuple) else [generator.target]
+            if not all(isinstance(target, ast.Name) for target in targets):
+                raise ValueError('comprehension targets must be names in safe mode')
+            names = [target.id for target in targets]
+            self.local_names.update(names)
+            conditions = [self.compile(condition) for condition in generator.ifs]
+            loops.append((iterable, names, isinstance(generator.target, ast.Tuple), conditions))
+        element = self.compile(node.elt)
+        self.local_names = saved
+
+        def generate(budget: Budget, env: dict[str, typing.Any], depth: int = 0) -> typing.Iterator[typing.Any]:
+            iterable, names, unpack, conditions = loops[depth]
+            for item in iterable(budget, env):
+                budget.tick()
+                scope = dict(env)
+                if unpack:
+                    scope.update(zip(names, item, strict=True))
+                else:
+                    scope[names[0]] = item
+                if all(condition(budget, scope) for condition in conditions):
+                    if depth + 1 < len(loops):
+                        yield from generate(budget, scope, depth + 1)
+                    else:
+                        yield element(budget, scope)
+
+        if isinstance(node, ast.ListComp):
+            def listcomp(budget: Budget, env: dict[str, typing.Any]) -> list[typing.Any]:
+                result = []
+                for value in generate(budget, env):
+                    result.append(value)
+                    budget.charge_items(1)
+                return result
+            return listcomp
+        return generate
+
+    compile_GeneratorExp = compile_comprehension
+    compile_ListComp = compile_comprehension
+
+
+def make_safe_names() -> dict[str, typing.Any]:
+    """Returns the names available to safe expressions."""
+    import builtins
+    names = make_globals()
+    names.update((name, getattr(builtins, name)) for name in SAFE_BUILTINS)
+    return names
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_safe_expression(exp: str, use_fraction: bool) -> _Node:
+    """Like compile_expression(), but compiles the expression for the safe evaluator."""
+    return SafeCompiler(make_safe_names()).compile(transform_expression(exp, use_fraction))
 
 
 def grouped(val: str, units: int) -> str:
@@ -224,16 +1178,35 @@ def format_fraction(fr: Fraction) -> str:
     return str(fr)
 
 
+def to_signed(value: int, bits: int) -> int:
+    """Interprets the low `bits` bits of value as a two's complement signed integer."""
+    value &= (1 << bits) - 1
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def format_epoch_millis(time_val: float, conv: typing.Callable[[int], time.struct_time]) -> str:
+    t = conv(int(time_val / 1000))
+    millis = int(time_val % 1000)
+    return (f'{t.tm_year:04}-{t.tm_mon:02}-{t.tm_mday:02} ' +
+            f'{t.tm_hour:02}:{t.tm_min:02}:{t.tm_sec:02}.{millis:03}')
+
+
 def show_result(result: typing.Any) -> None:
     global _primary_printed
     _primary_printed = False
 
+    if isinstance(result, Quantity):
+        primary, *others = result.renderings()
+        print(primary)
+        for rendering in others:
+            print(f'# = {rendering}')
+        _primary_printed = True
+        return
     if isinstance(result, Fraction):
         print(format_fraction(result))
-        if result.denominator == 1:
-            result = int(result)
-        else:
-            result = float(result)
+        result = to_number(result)
     elif isinstance(result, Decimal):
         try:
             fr = Fraction(result).limit_denominator()
@@ -261,9 +1234,7 @@ def show_result(result: typing.Any) -> None:
 
     print()
     print('# 32 bits')
-    value = 0xffffffff & int(result)
-    if value > 0x8000000:
-        value -= 0x100000000
+    value = to_signed(int(result), 32)
 
     print_with_grouped(f'{value}', 3)
     value = 0xffffffff & int(result)
@@ -272,9 +1243,7 @@ def show_result(result: typing.Any) -> None:
 
     print()
     print('# 64 bits')
-    value = 0xffffffffffffffff & int(result)
-    if value > 0x800000000000000:
-        value -= 0x10000000000000000
+    value = to_signed(int(result), 64)
     print_with_grouped(f'{value}', 3)
 
     value = 0xffffffffffffffff & int(result)
@@ -285,25 +1254,271 @@ def show_result(result: typing.Any) -> None:
         print()
         print('# GMT time, as millis since epoch')
 
-        def print_time(time_val: float, conv: typing.Callable[[int], time.struct_time]) -> None:
-            t = conv(int(time_val / 1000))
-            millis = int(time_val % 1000)
-            print(f'{t.tm_year:04}-{t.tm_mon:02}-{t.tm_mday:02} ' +
-                  f'{t.tm_hour:02}:{t.tm_min:02}:{t.tm_sec:02}.{millis:03}')
-
-        print_time(float(result), time.gmtime)
+        print(format_epoch_millis(float(result), time.gmtime))
 
         print()
         print('# Local time, as millis since epoch')
-        print_time(float(result), time.localtime)
+        print(format_epoch_millis(float(result), time.localtime))
     _primary_printed = True
 
 
-def run_repl(use_fraction: bool, globals_dict: dict[str, typing.Any]) -> None:
+def to_number(result: typing.Any) -> typing.Any:
+    """Converts a Fraction to the int or float (or Decimal, with -p) shown by show_result();
+    other values are returned as is."""
+    if isinstance(result, Fraction):
+        if result.denominator == 1:
+            return int(result)
+        if _precision is None:
+            try:
+                return float(result)
+            except OverflowError:
+                pass  # Beyond the float range.
+        return Decimal(result.numerator) / Decimal(result.denominator)
+    return result
+
+
+def format_time(value: typing.Any) -> str:
+    if value < 0 or value > 0xffffffffffffffff:
+        raise ValueError('out of range for an epoch timestamp')
+    return format_epoch_millis(float(value), time.gmtime)
+
+
+# Single representations for --format. Each takes a number (see to_number()) and returns its text.
+FORMATTERS: dict[str, typing.Callable[[typing.Any], str]] = {
+    'dec': lambda value: f'{value}',
+    'hex': lambda value: f'{int(value):#x}',
+    'bin': lambda value: f'{int(value):#b}',
+    'i32': lambda value: f'{to_signed(int(value), 32)}',
+    'u64': lambda value: f'{int(value) & 0xffffffffffffffff}',
+    'time': format_time,
+}
+OUTPUT_FORMATS = list(FORMATTERS) + ['json']
+
+
+def format_result(result: typing.Any, output_format: str) -> str:
+    """Renders only the requested representation of a result. 'json' renders all of them as
+    one JSON object, with null for those that don't apply. Representations that don't apply
+    otherwise (e.g. hex of NaN) are rendered as 'n/a'."""
+    value = to_number(result)
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal)):
+        if output_format == 'json':
+            import json
+            return json.dumps({'value': str(result)})
+        return str(result)
+
+    if output_format != 'json':
+        try:
+            return FORMATTERS[output_format](value)
+        except (ValueError, OverflowError, OSError):
+            return 'n/a'
+
+    import json
+    obj: dict[str, str | None] = {'value': str(result)}
+    for name, formatter in FORMATTERS.items():
+        try:
+            obj[name] = formatter(value)
+        except (ValueError, OverflowError, OSError):
+            obj[name] = None
+    return json.dumps(obj)
+
+
+def print_result(result: typing.Any, output_format: str | None) -> None:
+    """Prints a result in all representations, or only in `output_format` if given."""
+    if output_format is None:
+        show_result(result)
+    else:
+        print(format_result(result, output_format))
+
+
+class UserFunction:
+    """A function defined in the REPL, e.g. 'f(n) = n^2 + a'. Other session names in the
+    body are looked up when it is called."""
+    def __init__(self, session: 'Session', name: str, params: list[str], source: str) -> None:
+        self.session = session
+        self.name = name
+        self.params = params
+        self.source = source
+
+    def __call__(self, *args: typing.Any) -> typing.Any:
+        if len(args) != len(self.params):
+            raise TypeError(f'{self.name}() takes {len(self.params)} arguments ({len(args)} given)')
+        return self.session.evaluate_source(self.source, dict(zip(self.params, args)))
+
+    def __repr__(self) -> str:
+        params = ', '.join('x' if p == '_x' else p for p in self.params)
+        return f'{self.name}({params})'
+
+
+class Cell:
+    """A named value of the REPL session: a variable, a function or a numbered result.
+    `source` is None for values that can't be recomputed (self-referencing assignments)."""
+    __slots__ = ('name', 'source', 'params', 'deps')
+
+    def __init__(self, name: str, source: str | None, params: list[str] | None, deps: set[str]) -> None:
+        self.name = name
+        self.source = source
+        self.params = params
+        self.deps = deps
+
+
+class Session:
+    """State of the REPL: variables ('a = 3/7'), functions ('f(n) = n^2 + a') and numbered
+    results (_1, _2, ..., with _ for the latest). The dependencies between them are tracked,
+    so that after a variable changes, :recalc re-evaluates only the results that depend on it."""
+    ASSIGNMENT = re.compile(r'^([A-Za-z_]\w*)\s*(?:\(([^()]*)\))?\s*=(?!=)(.+)$')
+    RESULT_NAME = re.compile(r'^_\d*$')
+
+    def __init__(self, use_fraction: bool, globals_dict: dict[str, typing.Any],
+                 budget: Budget | None = None) -> None:
+        self.use_fraction = use_fraction
+        self.budget = budget
+        self.reserved = set(globals_dict) | set(SAFE_BUILTINS) | {'x'}
+        self.namespace = dict(globals_dict)  # For eval(): the globals plus the session values.
+        self.values: dict[str, typing.Any] = {}  # For the safe evaluator.
+        self.cells: dict[str, Cell] = {}
+        self.dependents: dict[str, set[str]] = {}
+        self.stale: set[str] = set()
+        self.count = 0
+
+    def evaluate_source(self, source: str, local_values: dict[str, typing.Any] | None = None) -> typing.Any:
+        if self.budget is not None:
+            env = {**self.values, **local_values} if local_values else self.values
+            node = compile_safe_expression(source, self.use_fraction)
+            with self.budget.alarm():
+                return node(self.budget, env)
+        return eval(compile_expression(source, self.use_fraction), self.namespace, local_values)
+
+    def set_value(self, name: str, value: typing.Any) -> None:
+        self.values[name] = value
+        self.namespace[name] = value
+
+    def references(self, source: str) -> set[str]:
+        """Returns the session names used by an expression."""
+        tree = transform_expression(source, self.use_fraction)
+        return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id in self.cells}
+
+    def closure(self, names: set[str]) -> set[str]:
+        """Returns names and everything they depend on, transitively."""
+        result: set[str] = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name not in result:
+                result.add(name)
+                todo.extend(self.cells[name].deps if name in self.cells else ())
+        return result
+
+    def mark_dependents_stale(self, name: str) -> int:
+        """Marks everything that depends on name as stale. Returns the number of stale values
+        (functions read the current values when called, so they aren't counted)."""
+        todo = list(self.dependents.get(name, ()))
+        marked = 0
+        while todo:
+            dependent = todo.pop()
+            if dependent not in self.stale and dependent != name:
+                self.stale.add(dependent)
+                marked += self.cells[dependent].params is None
+                todo.extend(self.dependents.get(dependent, ()))
+        return marked
+
+    def store(self, cell: Cell, value: typing.Any) -> None:
+        old = self.cells.get(cell.name)
+        for dep in old.deps if old else ():
+            self.dependents[dep].discard(cell.name)
+        for dep in cell.deps:
+            self.dependents.setdefault(dep, set()).add(cell.name)
+        self.cells[cell.name] = cell
+        self.set_value(cell.name, value)
+        self.stale.discard(cell.name)
+
+    def start(self) -> None:
+        if self.budget is not None:
+            self.budget.start()
+
+    def execute(self, line: str) -> tuple[str, typing.Any, int]:
+        """Executes a REPL line: an assignment, a function definition or an expression.
+        Returns (name, value, number of results that became stale)."""
+        self.start()
+        match = self.ASSIGNMENT.match(line)
+        if match:
+            name, params, source = match.group(1), match.group(2), match.group(3).strip()
+            return self.define(name, [p.strip() for p in params.split(',') if p.strip()]
+                               if params is not None else None, source)
+
+        # '_' is the latest result at the time of typing, so the dependency is on that result.
+        if self.count:
+            line = re.sub(r'(?<![\w.])_(?!\w)', f'_{self.count}', line)
+        name = f'_{self.count + 1}'
+        value = self.evaluate_source(line)
+        self.store(Cell(name, line, None, self.references(line)), value)
+        self.count += 1
+        self.set_value('_', value)
+        return name, value, 0
+
+    def define(self, name: str, params: list[str] | None, source: str) -> tuple[str, typing.Any, int]:
+        if name in self.reserved or self.RESULT_NAME.match(name):
+            raise ValueError(f"'{name}' is reserved and can't be assigned")
+        if params is not None:
+            if not all(re.fullmatch(r'[A-Za-z_]\w*', p) for p in params):
+                raise ValueError(f'invalid parameters: {", ".join(params)}')
+            body = source
+            if 'x' in params:
+                body = protect_x(source)
+                params = ['_x' if p == 'x' else p for p in params]
+            deps = self.references(body) - set(params) - {name}
+            value: typing.Any = UserFunction(self, name, params, body)
+            # The previous value of a redefined function is no longer callable by name.
+            self.set_value(name, value)
+        else:
+            deps = self.references(source)
+            if name in self.closure(deps - {name}):
+                raise ValueError(f"circular dependency: {', '.join(sorted(deps - {name}))} already depends on '{name}'")
+            value = self.evaluate_source(source)
+            if name in deps:
+                # 'a = a + 1' uses the previous value of a, so it can't be recomputed.
+                source, deps = None, set()
+        self.store(Cell(name, source, params, deps), value)
+        return name, value, self.mark_dependents_stale(name)
+
+    def recalc(self) -> list[tuple[str, typing.Any]]:
+        """Re-evaluates the stale results in dependency order. Returns the updated (name, value)s."""
+        import graphlib
+        self.start()
+        sorter = graphlib.TopologicalSorter({name: self.cells[name].deps & self.stale for name in self.stale})
+        updated = []
+        for name in sorter.static_order():
+            cell = self.cells[name]
+            if cell.source is not None and cell.params is None:
+                value = self.evaluate_source(cell.source)
+                self.set_value(name, value)
+                updated.append((name, value))
+            self.stale.discard(name)
+        if updated and self.count:
+            self.set_value('_', self.values[f'_{self.count}'])
+        return updated
+
+    def describe(self) -> list[str]:
+        """Returns one line per session name, with its definition and value."""
+        lines = []
+        for name, cell in self.cells.items():
+            value = self.values[name]
+            if isinstance(value, UserFunction):
+                lines.append(f'{value!r} = {cell.source}')
+                continue
+            definition = f'{name} = {cell.source}' if cell.source is not None else name
+            mark = ' (stale)' if name in self.stale else ''
+            lines.append(f'{definition}  # {value}{mark}')
+        return lines
+
+
+def run_repl(use_fraction: bool, globals_dict: dict[str, typing.Any],
+             output_format: str | None = None, budget: Budget | None = None) -> None:
     """Runs an interactive REPL loop."""
     print("calc.py Interactive REPL")
     lines = [
         "Hint: Use '^' for power (e.g. 2^3) and '@' for fraction (e.g. 1@2)",
+        "Assign with 'a = 3/7', define functions with 'f(n) = n^2 + a', and use _ or _1, _2, ...",
+        "for previous results. ':recalc' updates results after a change, ':vars' lists names.",
         "Type your expression and press Enter. Type 'exit' or 'quit' to exit."
     ]
     for line in lines:
@@ -317,6 +1532,7 @@ def run_repl(use_fraction: bool, globals_dict: dict[str, typing.Any]) -> None:
     except ImportError:
         pass
 
+    session = Session(use_fraction, globals_dict, budget)
     while True:
         try:
             prompt = "\033[1;32mcalc> \033[0m" if sys.stdout.isatty() else "calc> "
@@ -337,27 +1553,574 @@ def run_repl(use_fraction: bool, globals_dict: dict[str, typing.Any]) -> None:
             continue
 
         try:
-            line_str = preprocess_expression(line_str)
-            if use_fraction:
-                tree = ast.parse(line_str, mode="eval")
-                transformer = FractionTransformer()
-                new_tree = transformer.visit(tree)
-                ast.fix_missing_locations(new_tree)
-                code = compile(new_tree, "<string>", "eval")
-                result = eval(code, globals_dict)
-            else:
-                tree = ast.parse(line_str, mode="eval")
-                transformer = DecimalTransformer()
-                new_tree = transformer.visit(tree)
-                ast.fix_missing_locations(new_tree)
-                code = compile(new_tree, "<string>", "eval")
-                result = eval(code, globals_dict)
-
-            show_result(result)
+            if line_str == ":recalc":
+                updated = session.recalc()
+                for name, value in updated:
+                    print(f"{name} = {value}")
+                if not updated:
+                    print("# Nothing to recalculate")
+                continue
+            if line_str == ":vars":
+                for description in session.describe():
+                    print(description)
+                continue
+
+            name, result, stale = session.execute(line_str)
+            if isinstance(result, UserFunction):
+                print(f"# {result!r} defined")
+                continue
+            print(f"# {name}")
+            print_result(result, output_format)
+            if stale:
+                print(f"# {stale} dependent result(s) out of date; ':recalc' to update")
         except Exception as e:
             print(f"Error: {e}")
 
 
+def pop_option(args: list[str], name: str) -> tuple[str | None, list[str]]:
+    """Removes an option that takes a value ('--name VALUE' or '--name=VALUE') from args.
+    Returns (value or None, remaining args)."""
+    for i, arg in enumerate(args):
+        if arg == name:
+            if i + 1 == len(args):
+                raise ValueError(f'{name} requires a value')
+            return args[i + 1], args[:i] + args[i + 2:]
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:], args[:i] + args[i + 1:]
+    return None, args
+
+
+def pop_format(args: list[str]) -> tuple[str | None, list[str]]:
+    """Removes the --format option from args. Returns (output format or None, remaining args)."""
+    output_format, args = pop_option(args, '--format')
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown format '{output_format}' (choose from {', '.join(OUTPUT_FORMATS)})")
+    return output_format, args
+
+
+def protect_x(exp: str) -> str:
+    """Renames a variable 'x' to '_x', so that preprocess_expression() doesn't read it as the
+    multiplication operator. Implicit multiplication such as '2x' is accepted."""
+    exp = re.sub(r'(?<=\d)x\b', '*_x', exp)
+    return re.sub(r'\bx\b', '_x', exp)
+
+
+def compile_map_expression(exp: str) -> types.CodeType:
+    """Compiles a --map expression of the input value `x`. A standalone 'x' is always the
+    variable, never multiplication. Literals are left as plain Python numbers (no
+    Fraction/BigDecimal transformation), so the code also works on numpy arrays."""
+    return compile(preprocess_expression(protect_x(exp)), '<map>', 'eval')
+
+
+def run_map(exp: str, lines: typing.Iterable[str], output: typing.TextIO,
+            use_numpy: bool | None = None, chunk_size: int = MAP_CHUNK_SIZE,
+            output_format: str = 'dec') -> None:
+    """Evaluates `exp` for each number in `lines` (blank lines are skipped), writing one result
+    per line in `output_format`. Chunks of `chunk_size` values are evaluated at once as numpy arrays, falling back to
+    one evaluation per value if numpy is not installed (or `use_numpy` is False), or if the
+    expression doesn't work on arrays. Raises ValueError, with the line number, for a line that
+    is not a number or on which the expression fails."""
+    code = compile_map_expression(exp)
+    globals_dict = make_globals()
+    if use_numpy is None:
+        import importlib.util
+        use_numpy = importlib.util.find_spec('numpy') is not None
+    it = enumerate(lines, 1)
+    while True:
+        raw = list(itertools.islice(it, chunk_size))
+        if not raw:
+            break
+        numbered = [(lineno, v) for lineno, v in ((lineno, line.strip()) for lineno, line in raw) if v]
+        if not numbered:
+            continue
+        results = None
+        if use_numpy:
+            try:
+                xs = np.array([v for _, v in numbered], dtype=np.float64)
+            except ValueError:
+                # Not a number: the per-value evaluation below reports the line.
+                xs = None
+            if xs is not None:
+                globals_dict['_x'] = xs
+                try:
+                    results = np.broadcast_to(np.asarray(eval(code, globals_dict)), xs.shape).tolist()
+                except (ArithmeticError, TypeError, NameError, ValueError):
+                    # Scalar-only expression (e.g. math.sqrt(x), max(x, 0), conditionals), or
+                    # an error that the per-value evaluation reports with its line.
+                    use_numpy = False
+        if results is None:
+            results = []
+            for lineno, value in numbered:
+                try:
+                    globals_dict['_x'] = float(value)
+                    results.append(eval(code, globals_dict))
+                except (ArithmeticError, TypeError, NameError, ValueError) as e:
+                    raise ValueError(f'line {lineno}: {value}: {e}') from e
+        if output_format == 'dec':
+            output.write('\n'.join(map(str, results)) + '\n')
+        else:
+            output.write('\n'.join(format_result(r, output_format) for r in results) + '\n')
+
+
+# Number of values P2Quantile keeps to compute quantiles exactly, before switching to P².
+EXACT_QUANTILE_VALUES = 512
+
+
+class P2Quantile:
+    """Estimates a quantile of a stream in constant memory with the P² algorithm (Jain and
+    Chlamtac, 1985): five markers track the minimum, the quantile, the maximum and two points
+    in between, and are moved along a piecewise-parabolic curve as values arrive.
+
+    The first EXACT_QUANTILE_VALUES values are kept sorted, and the quantile is computed
+    exactly from them, since P² needs many values to converge. Once there are more, the
+    markers are seeded with the exact quantiles of the kept values."""
+    def __init__(self, p: float) -> None:
+        self.p = p
+        self.values: list[float] | None = []
+        self.heights: list[float] = []
+        self.positions: list[int] = []
+        self.desired: list[float] = []
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+        import bisect
+        self.insort = bisect.insort
+
+    def add(self, x: float) -> None:
+        if self.values is not None:
+            self.insort(self.values, x)
+            if len(self.values) > EXACT_QUANTILE_VALUES:
+                self.seed()
+            return
+        q = self.heights
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self.desired
+        for i in range(5):
+            desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise-parabolic prediction, or linear if it would break the ordering.
+                h = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def seed(self) -> None:
+        """Places the markers at their desired positions (1-based ranks) in the kept values,
+        and drops the values."""
+        values = self.values
+        assert values is not None
+        count = len(values)
+        self.desired = [1 + (count - 1) * increment for increment in self.increments]
+        positions = [1] + [round(d) for d in self.desired[1:4]] + [count]
+        # Markers need distinct positions.
+        for i in range(1, 4):
+            positions[i] = max(positions[i], positions[i - 1] + 1)
+        for i in range(3, 0, -1):
+            positions[i] = min(positions[i], positions[i + 1] - 1)
+        self.positions = positions
+        self.heights = [values[position - 1] for position in positions]
+        self.values = None
+
+    def value(self) -> float:
+        q = self.values
+        if q is None:
+            return self.heights[2]
+        if not q:
+            return math.nan
+        # Linear interpolation between the closest ranks.
+        rank = self.p * (len(q) - 1)
+        low = int(rank)
+        high = min(low + 1, len(q) - 1)
+        return q[low] + (q[high] - q[low]) * (rank - low)
+
+
+# Quantiles estimated by --stats.
+STATS_QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+
+class RunningStats:
+    """Aggregates of a stream of numbers in constant memory: count, exact sum, min and max,
+    mean and variance with Welford's algorithm, P² estimates of STATS_QUANTILES, and a
+    histogram with one bucket per power of two (so at most a few thousand buckets).
+    NaNs and infinities, and ints too large for a float, are only counted, apart, as they would
+    poison the other aggregates."""
+    def __init__(self) -> None:
+        self.count = 0
+        self.non_finite = 0
+        self.total: int | float = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min: int | float | None = None
+        self.max: int | float | None = None
+        self.quantiles = [P2Quantile(p) for p in STATS_QUANTILES]
+        self.buckets: dict[int, int] = {}
+
+    def add(self, value: int | float) -> None:
+        try:
+            x = float(value)
+        except OverflowError:
+            x = math.inf
+        if not math.isfinite(x):
+            self.non_finite += 1
+            return
+        self.count += 1
+        self.total += value
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        for quantile in self.quantiles:
+            quantile.add(x)
+        bucket = bucket_of(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def aggregates(self) -> list[tuple[str, typing.Any]]:
+        """Returns the aggregates by name, in display order."""
+        result: list[tuple[str, typing.Any]] = [('count', self.count)]
+        if self.non_finite:
+            result.append(('non-finite', self.non_finite))
+        if not self.count:
+            return result
+        variance = self.m2 / (self.count - 1) if self.count > 1 else 0.0
+        result += [('sum', self.total), ('mean', self.mean), ('stddev', math.sqrt(variance)),
+                   ('variance', variance), ('min', self.min)]
+        result += [(f'p{p * 100:g}', q.value()) for p, q in zip(STATS_QUANTILES, self.quantiles)]
+        result.append(('max', self.max))
+        return result
+
+
+def bucket_of(value: int | float) -> int:
+    """Returns the histogram bucket of a value: 1100 + e for values in [2^(e-1), 2^e), negated
+    for negative values, so that buckets sort like their values. Zero is bucket 0."""
+    if value == 0:
+        return 0
+    magnitude = abs(value)
+    e = magnitude.bit_length() if isinstance(magnitude, int) else math.frexp(magnitude)[1]
+    bucket = e + 1100  # Keeps buckets of fractions (e <= 0) positive; frexp() is >= -1073.
+    return bucket if value > 0 else -bucket
+
+
+def bucket_range(bucket: int) -> str:
+    """Renders the range of values of a histogram bucket (see bucket_of())."""
+    if bucket == 0:
+        return '0'
+    e = abs(bucket) - 1100
+    low, high = (2 ** (e - 1), 2 ** e) if e >= 1 else (2.0 ** (e - 1), 2.0 ** e)
+    if bucket < 0:
+        return f'(-{high:g}, -{low:g}]'
+    return f'[{low:g}, {high:g})'
+
+
+def format_aggregate(value: int | float) -> str:
+    """Renders an aggregate of --stats in decimal, followed by hex if it is a whole number."""
+    if isinstance(value, float) and not value.is_integer():
+        return f'{value:.10g}'
+    text = grouped(f'{int(value)}', 3)
+    if value >= 0:
+        text += f'  0x{grouped(f"{int(value):x}", 4)}'
+    return text
+
+
+def parse_number(text: str) -> int | float:
+    """Parses an input number of --stats: an integer (also 0x, 0b, 0o, 1_000) or a float."""
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return int(text, 0)
+    except ValueError:
+        return float(text)
+
+
+def run_stats(lines: typing.Iterable[str], output: typing.TextIO,
+              output_format: str | None = None) -> int:
+    """Reads one number per line (blank lines are skipped) in a single pass, and prints the
+    aggregates of RunningStats with their decimal and hex renderings and the histogram, or
+    only the aggregates in `output_format` if given. Lines that aren't numbers are reported on
+    stderr and skipped. Returns the number of such lines."""
+    stats = RunningStats()
+    errors = 0
+    for line_no, line in enumerate(lines, 1):
+        text = line.strip()
+        if not text:
+            continue
+        try:
+            value = parse_number(text)
+        except ValueError:
+            sys.stderr.write(f'calc.py: --stats: line {line_no}: not a number: {text!r}\n')
+            errors += 1
+            continue
+        stats.add(value)
+
+    aggregates = stats.aggregates()
+    if output_format is not None:
+        for name, value in aggregates:
+            if output_format == 'json':
+                import json
+                output.write(json.dumps({'name': name, **json.loads(format_result(value, 'json'))}) + '\n')
+            else:
+                output.write(f'{name}\t{format_result(value, output_format)}\n')
+        return errors
+
+    width = max(len(name) for name, _ in aggregates)
+    for name, value in aggregates:
+        output.write(f'{name:<{width}}  {format_aggregate(value)}\n')
+
+    if stats.buckets:
+        output.write('\n# Histogram\n')
+        peak = max(stats.buckets.values())
+        ranges = {bucket: bucket_range(bucket) for bucket in stats.buckets}
+        range_width = max(len(text) for text in ranges.values())
+        count_width = len(str(peak))
+        for bucket in sorted(stats.buckets):
+            count = stats.buckets[bucket]
+            bar = '#' * max(1, round(count * 40 / peak))
+            output.write(f'{ranges[bucket]:>{range_width}}  {count:>{count_width}}  {bar}\n')
+    return errors
+
+
+_worker_globals: dict[str, typing.Any] = {}
+_worker_budget: Budget | None = None
+
+
+def _init_worker(digits: int | None, safe: bool) -> None:
+    """Sets up the warm state of a --jobs worker process."""
+    global _worker_globals, _worker_budget, _precision
+    _worker_globals = make_globals()
+    _worker_budget = Budget() if safe else None
+    if digits is not None:
+        _precision = digits
+        decimal.getcontext().prec = digits
+
+
+def evaluate_lines(first_line: int, lines: list[str], use_fraction: bool,
+                   output_format: str | None) -> tuple[str, int]:
+    """Evaluates a chunk of input lines in a --jobs worker. Errors are reported inline with their
+    line number instead of stopping. Returns (output, number of errors)."""
+    out = io.StringIO()
+    errors = 0
+    with contextlib.redirect_stdout(out):
+        for line_no, line in enumerate(lines, first_line):
+            line_str = line.strip()
+            if not line_str:
+                continue
+            try:
+                print_result(evaluate(line_str, use_fraction, _worker_globals, _worker_budget), output_format)
+            except Exception as e:
+                print(f'Error: line {line_no}: {e}')
+                errors += 1
+    return out.getvalue(), errors
+
+
+def run_pipeline(lines: typing.Iterable[str], jobs: int, output: typing.TextIO, use_fraction: bool = True,
+                 output_format: str | None = None, digits: int | None = None, safe: bool = False) -> int:
+    """Evaluates input lines in chunks on a pool of `jobs` worker processes, writing the results
+    in input order. Only a bounded number of chunks is read ahead. Returns the number of errors."""
+    import collections
+    import concurrent.futures
+    errors = 0
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                                initargs=(digits, safe)) as pool:
+        pending: collections.deque[concurrent.futures.Future] = collections.deque()
+        it = iter(lines)
+        line_no = 1
+        while True:
+            chunk = list(itertools.islice(it, PIPELINE_CHUNK_SIZE))
+            if chunk:
+                pending.append(pool.submit(evaluate_lines, line_no, chunk, use_fraction, output_format))
+                line_no += len(chunk)
+            if not pending:
+                break
+            if not chunk or len(pending) >= jobs * PIPELINE_WINDOW:
+                text, chunk_errors = pending.popleft().result()
+                output.write(text)
+                errors += chunk_errors
+    return errors
+
+
+def parse_mode_flags(args: list[str]) -> tuple[bool, list[str]]:
+    """Removes the -f/--fraction and -n/--no-fraction flags from args.
+    Returns (use_fraction, remaining args)."""
+    use_fraction = True
+    if '-f' in args:
+        args = [arg for arg in args if arg != '-f']
+    if '--fraction' in args:
+        args = [arg for arg in args if arg != '--fraction']
+    if '-n' in args:
+        use_fraction = False
+        args = [arg for arg in args if arg != '-n']
+    if '--no-fraction' in args:
+        use_fraction = False
+        args = [arg for arg in args if arg != '--no-fraction']
+    return use_fraction, args
+
+
+def parse_precision(args: list[str]) -> tuple[int | None, list[str]]:
+    """Removes the -p/--precision option from args. Returns (digits or None, remaining args)."""
+    value, args = pop_option(args, '-p')
+    if value is None:
+        value, args = pop_option(args, '--precision')
+    if value is None:
+        return None, args
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError(f"precision must be a positive integer, not '{value}'")
+    return int(value), args
+
+
+@contextlib.contextmanager
+def precision(digits: int | None) -> typing.Iterator[None]:
+    """Evaluates and renders results with `digits` significant digits, if given."""
+    global _precision
+    if digits is None:
+        yield
+        return
+    saved = _precision
+    _precision = digits
+    try:
+        with decimal.localcontext() as ctx:
+            ctx.prec = digits
+            yield
+    finally:
+        _precision = saved
+
+
+def make_globals() -> dict[str, typing.Any]:
+    """Returns the names available to expressions."""
+    return {
+        'Fraction': Fraction,
+        'F': Fraction,
+        'Decimal': BigDecimal,
+        'D': BigDecimal,
+        'BigDecimal': BigDecimal,
+        '_div': _div,
+        '_frac': _frac,
+        '_Q': _Q,
+        '_rdiv': _rdiv,
+        '_pow': _pow,
+        '_unit': _unit,
+        '_convert': _convert,
+        'math': math,
+        'np': np,
+        'time': time,
+    }
+
+
+def socket_path() -> str:
+    """Returns the per-user socket of the calc server. Keep in sync with calc-client."""
+    if 'CALC_SOCKET' in os.environ:
+        return os.environ['CALC_SOCKET']
+    import tempfile
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, f'calc-{os.getuid()}.sock')
+
+
+class _CapturedOutput(io.StringIO):
+    """Collects the output of a server request, reporting the client's terminal state so
+    that the primary answer is highlighted the same way as when running locally."""
+    def __init__(self, tty: bool) -> None:
+        super().__init__()
+        self.tty = tty
+
+    def isatty(self) -> bool:
+        return self.tty
+
+
+def handle_request(fields: list[str], globals_dict: dict[str, typing.Any]) -> tuple[int, str]:
+    """Evaluates a client request, [tty flag ('1' or '0'), args...], with the safe evaluator.
+    Returns (exit status, output)."""
+    use_fraction, args = parse_mode_flags(fields[1:])
+    out = _CapturedOutput(fields[0] == '1')
+    try:
+        output_format, args = pop_format(args)
+        digits, args = parse_precision(args)
+        budget = Budget()
+        if digits is not None:
+            budget.check_bits(digits * LOG2_10)
+        with contextlib.redirect_stdout(out), precision(digits):
+            print_result(evaluate(' '.join(args), use_fraction, globals_dict, budget), output_format)
+    except Exception as e:
+        return 1, out.getvalue()[:SERVER_MAX_OUTPUT] + f'Error: {e}\n'
+    output = out.getvalue()
+    if len(output) > SERVER_MAX_OUTPUT:
+        return 1, f'Error: output of {len(output)} characters exceeds the limit of {SERVER_MAX_OUTPUT}\n'
+    return 0, output
+
+
+def serve(path: str, idle_timeout: float) -> None:
+    """Runs the calc server on the Unix socket `path` until no request arrives for
+    `idle_timeout` seconds, or calc.py itself is modified.
+
+    Requests are the client's arguments, NUL-separated, terminated by closing the write side.
+    The response is the exit status on the first line followed by the output."""
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.connect(path)
+        return  # Another server is already running.
+    except OSError:
+        pass
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    inode = os.stat(path).st_ino
+    sock.listen(16)
+    sock.settimeout(idle_timeout)
+
+    globals_dict = make_globals()
+    source_mtime = os.stat(__file__).st_mtime
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                break
+            with conn:
+                conn.settimeout(SERVER_REQUEST_TIMEOUT)
+                try:
+                    chunks = []
+                    while chunk := conn.recv(65536):
+                        chunks.append(chunk)
+                    fields = b''.join(chunks).decode().split('\0')
+                    status, output = handle_request(fields, globals_dict)
+                    conn.sendall(f'{status}\n{output}'.encode())
+                except (OSError, UnicodeDecodeError):
+                    pass
+            if os.stat(__file__).st_mtime != source_mtime:
+                break  # Let the next client spawn a server running the new code.
+    finally:
+        sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+
+
 def main(args: list[str]) -> None:
     # Check for help flags
     if '-h' in args or '--help' in args:
@@ -366,7 +2129,6 @@ def main(args: list[str]) -> None:
 
     # Check for test flags
     if '-t' in args or '--test' in args:
-        import os
         import unittest
         script_dir = os.path.dirname(os.path.abspath(__file__))
         if script_dir not in sys.path:
@@ -386,88 +2148,91 @@ def main(args: list[str]) -> None:
         use_interactive = True
         args = [arg for arg in args if arg != '--interactive']
 
-    # Check for fraction flag
-    use_fraction = True
-    if '-f' in args:
-        args = [arg for arg in args if arg != '-f']
-    if '--fraction' in args:
-        args = [arg for arg in args if arg != '--fraction']
-    if '-n' in args:
-        use_fraction = False
-        args = [arg for arg in args if arg != '-n']
-    if '--no-fraction' in args:
-        use_fraction = False
-        args = [arg for arg in args if arg != '--no-fraction']
+    # Check for server flag
+    if '--server' in args:
+        serve(socket_path(), float(os.environ.get('CALC_SERVER_IDLE', DEFAULT_SERVER_IDLE)))
+        return
+
+    use_fraction, args = parse_mode_flags(args)
+
+    budget = None
+    if '--safe' in args:
+        budget = Budget()
+        args = [arg for arg in args if arg != '--safe']
+
+    try:
+        map_exp, args = pop_option(args, '--map')
+        output_format, args = pop_format(args)
+        digits, args = parse_precision(args)
+        jobs_value, args = pop_option(args, '--jobs')
+        if jobs_value is not None and (not jobs_value.isdigit() or int(jobs_value) < 1):
+            raise ValueError(f"--jobs must be a positive integer, not '{jobs_value}'")
+        if map_exp is not None and jobs_value is not None:
+            raise ValueError('--jobs cannot be combined with --map')
+        if map_exp is not None and budget is not None:
+            # --map evaluates with eval() on plain numbers or numpy arrays.
+            raise ValueError('--safe cannot be combined with --map')
+        use_stats = '--stats' in args
+        if use_stats:
+            args = [arg for arg in args if arg != '--stats']
+            if map_exp is not None or jobs_value is not None:
+                raise ValueError('--stats cannot be combined with --map or --jobs')
+    except ValueError as e:
+        sys.exit(f'calc.py: {e}')
+
+    if use_stats:
+        # The remaining arguments are input files.
+        import fileinput
+        if run_stats(fileinput.input(args), sys.stdout, output_format):
+            sys.exit(1)
+        return
+
+    if jobs_value is not None:
+        # The remaining arguments are input files.
+        import fileinput
+        errors = run_pipeline(fileinput.input(args), int(jobs_value), sys.stdout, use_fraction,
+                              output_format, digits, budget is not None)
+        if errors:
+            sys.exit(1)
+        return
+
+    if map_exp is not None:
+        import fileinput
+        try:
+            run_map(map_exp, fileinput.input(args), sys.stdout, output_format=output_format or 'dec')
+        except (SyntaxError, ValueError) as e:
+            sys.exit(f'calc.py: --map: {e}')
+        return
 
     if not args and sys.stdin.isatty():
         use_interactive = True
 
+    cache_dir = os.environ.get('CALC_CACHE_DIR')
+    if cache_dir and (_disk_cache is None or os.path.dirname(_disk_cache.path) != cache_dir):
+        enable_disk_cache(cache_dir)
+
     # Update sys.argv so that fileinput doesn't get confused
     sys.argv = [sys.argv[0]] + args
 
-    globals_dict = {
-        'Fraction': Fraction,
-        'F': Fraction,
-        'Decimal': BigDecimal,
-        'D': BigDecimal,
-        'BigDecimal': BigDecimal,
-        '_div': _div,
-        '_frac': _frac,
-        'math': math,
-        'np': np,
-        'time': time,
-    }
-
-    if use_interactive:
-        run_repl(use_fraction, globals_dict)
-        return
+    globals_dict = make_globals()
 
-    if args:
-        exp = ' '.join(args)
-        exp = preprocess_expression(exp)
-
-        if use_fraction:
-            tree = ast.parse(exp, mode='eval')
-            transformer = FractionTransformer()
-            new_tree = transformer.visit(tree)
-            ast.fix_missing_locations(new_tree)
-            code = compile(new_tree, '<string>', 'eval')
-            result = eval(code, globals_dict)
+    with precision(digits):
+        if use_interactive:
+            run_repl(use_fraction, globals_dict, output_format, budget)
+        elif args:
+            exp = ' '.join(args)
+            result = evaluate(exp, use_fraction, globals_dict, budget)
+            print_result(result, output_format)
         else:
-            tree = ast.parse(exp, mode='eval')
-            transformer = DecimalTransformer()
-            new_tree = transformer.visit(tree)
-            ast.fix_missing_locations(new_tree)
-            code = compile(new_tree, '<string>', 'eval')
-            result = eval(code, globals_dict)
-
-        show_result(result)
-    else:
-        # Non-interactive mode (e.g. piped input like `echo "1+2" | calc.py` when no arguments are specified).
-        for line in fileinput.input():
-            line_str = line.strip()
-            if not line_str:
-                continue
-            
-            line_str = preprocess_expression(line_str)
-            
-            if use_fraction:
-                tree = ast.parse(line_str, mode='eval')
-                transformer = FractionTransformer()
-                new_tree = transformer.visit(tree)
-                ast.fix_missing_locations(new_tree)
-                code = compile(new_tree, '<string>', 'eval')
-                result = eval(code, globals_dict)
-            else:
-                tree = ast.parse(line_str, mode='eval')
-                transformer = DecimalTransformer()
-                new_tree = transformer.visit(tree)
-                ast.fix_missing_locations(new_tree)
-                code = compile(new_tree, '<string>', 'eval')
-                result = eval(code, globals_dict)
-            
-            show_result(result)
-
+            # Non-interactive mode (e.g. piped input like `echo "1+2" | calc.py` when no arguments are specified).
+            import fileinput
+            for line in fileinput.input():
+                line_str = line.strip()
+                if not line_str:
+                    continue
+
+                result = evaluate(line_str, use_fraction, globals_dict, budget)
+                print_result(result, output_format)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -5,13 +5,40 @@
 # and different numeric representation outputs.
 #
 
+import contextlib
+import importlib.util
 import io
+import json
+import os
+import subprocess
 import sys
+import tempfile
+import threading
 import unittest
+from importlib.machinery import SourceFileLoader
 from unittest.mock import patch
 from fractions import Fraction
 import calc
 
+# Load the bench script (extensionless) for the micro-benchmarks.
+_bench_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+_bench_loader = SourceFileLoader("bench", _bench_path)
+_bench_spec = importlib.util.spec_from_file_location("bench", _bench_path, loader=_bench_loader)
+if _bench_spec is None or _bench_spec.loader is None:
+    raise ImportError("Could not import bench")
+bench = importlib.util.module_from_spec(_bench_spec)
+sys.modules["bench"] = bench
+_bench_spec.loader.exec_module(bench)
+
+# Load the calc-client script (extensionless).
+_client_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calc-client")
+_client_loader = SourceFileLoader("calc_client", _client_path)
+_client_spec = importlib.util.spec_from_file_location("calc_client", _client_path, loader=_client_loader)
+if _client_spec is None or _client_spec.loader is None:
+    raise ImportError("Could not import calc-client")
+calc_client = importlib.util.module_from_spec(_client_spec)
+_client_spec.loader.exec_module(calc_client)
+
 
 class TestHelperFunctions(unittest.TestCase):
     def test_grouped(self) -> None:
@@ -62,6 +89,610 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(calc.preprocess_expression("2 * 3 ^ 2"), "2 * 3 ** 2")
 
 
+class TestCompileCache(unittest.TestCase):
+    def test_compile_expression_is_cached(self) -> None:
+        calc.compile_expression.cache_clear()
+        code = calc.compile_expression("2x3 + 1/2", True)
+        self.assertIs(calc.compile_expression("2x3 + 1/2", True), code)
+        self.assertIsNot(calc.compile_expression("2x3 + 1/2", False), code)
+        self.assertEqual(calc.compile_expression.cache_info().hits, 1)
+        self.assertEqual(eval(code, calc.make_globals()), Fraction(13, 2))
+
+    def test_disk_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = calc.CodeCache(tmp)
+            self.assertIsNone(cache.get(("fraction", "1+2")))
+            cache.put(("fraction", "1+2"), compile("1+2", "<string>", "eval"))
+            cache.save()
+            self.assertIn(sys.implementation.cache_tag, os.path.basename(cache.path))
+
+            reloaded = calc.CodeCache(tmp)
+            code = reloaded.get(("fraction", "1+2"))
+            self.assertIsNotNone(code)
+            self.assertEqual(eval(code), 3)
+
+            # A corrupt file is ignored rather than failing the evaluation.
+            with open(cache.path, "wb") as f:
+                f.write(b"garbage")
+            self.assertIsNone(calc.CodeCache(tmp).get(("fraction", "1+2")))
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_numpy_not_imported_for_plain_arithmetic(self) -> None:
+        script = ("import sys; import calc; calc.main(['1/3 + 2x3']); "
+                  "print('numpy' in sys.modules, file=sys.stderr)")
+        proc = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn("6 + 1/3", proc.stdout)
+        self.assertEqual(proc.stderr.strip(), "False")
+
+    def test_lazy_module(self) -> None:
+        lazy = calc.LazyModule("json")
+        self.assertIn("not loaded", repr(lazy))
+        self.assertEqual(lazy.dumps([1]), "[1]")
+        self.assertIn("(loaded)", repr(lazy))
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_numpy_expression(self) -> None:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.main(["np.sqrt(16)"])
+        self.assertIn("4.0", out.getvalue())
+
+
+class TestExactArithmetic(unittest.TestCase):
+    def evaluate(self, exp: str) -> object:
+        return calc.evaluate(exp, True, calc.make_globals())
+
+    def test_integer_fast_path(self) -> None:
+        self.assertIs(type(self.evaluate("6/3 + 2^10")), int)
+        self.assertEqual(self.evaluate("6/3 + 2^10"), 1026)
+        self.assertEqual(self.evaluate("1/3 + 1/6"), Fraction(1, 2))
+        self.assertEqual(self.evaluate("2^-2"), Fraction(1, 4))
+        self.assertEqual(self.evaluate("0.1 + 0.2"), Fraction(3, 10))
+        self.assertEqual(self.evaluate("2^0.5"), 2 ** 0.5)
+        self.assertEqual(self.evaluate("1e-5 * 10^5"), 1)
+        # Rationals are Fractions, whether or not a faster rational type is installed.
+        self.assertIs(type(self.evaluate("1/3")), Fraction)
+        self.assertEqual(self.evaluate("(0.333).limit_denominator(10)"), Fraction(1, 3))
+        with self.assertRaises(ZeroDivisionError):
+            self.evaluate("1/0")
+
+    def test_parse_precision(self) -> None:
+        self.assertEqual(calc.parse_precision(["-p", "50", "1/7"]), (50, ["1/7"]))
+        self.assertEqual(calc.parse_precision(["--precision=5", "1"]), (5, ["1"]))
+        self.assertEqual(calc.parse_precision(["1"]), (None, ["1"]))
+        with self.assertRaises(ValueError):
+            calc.parse_precision(["-p", "0", "1"])
+
+    def test_main_precision(self) -> None:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.main(["-p", "40", "--format", "dec", "1/7"])
+            calc.main(["-n", "-p", "5", "--format", "dec", "1/7"])
+            calc.main(["--format", "dec", "1/7"])
+        self.assertEqual(out.getvalue().splitlines(),
+                         ["0." + "142857" * 6 + "1429", "0.14286", str(1 / 7)])
+
+
+class TestUnits(unittest.TestCase):
+    def evaluate(self, exp: str, use_fraction: bool = True) -> object:
+        return calc.evaluate(exp, use_fraction, calc.make_globals())
+
+    def test_replace_units(self) -> None:
+        self.assertEqual(calc.replace_units("512MiB / 3ms"), "_unit(512, 'MiB') / _unit(3, 'ms')")
+        self.assertEqual(calc.replace_units("10Gbit/s in MB/s"), "_convert((_unit(10, 'Gbit/s')), 'MB/s')")
+        self.assertEqual(calc.replace_units("1.5 h"), "_unit(1.5, 'h')")
+        for exp in ["0x1F", "0b101", "1e5", "2 * min(3, 4)", "a + b"]:
+            self.assertEqual(calc.replace_units(exp), exp)
+
+    def test_exact_arithmetic(self) -> None:
+        rate = self.evaluate("512MiB / 3ms")
+        self.assertEqual(rate.value, Fraction(512 * 2**20 * 8 * 1000, 3))
+        self.assertEqual(rate.dims, (1, -1, 0))
+        self.assertEqual(self.evaluate("1GB / 1MB"), 1000)
+        self.assertEqual(self.evaluate("1KiB / 1B"), 1024)
+        self.assertEqual(self.evaluate("3ms + 500us"), self.evaluate("3500us"))
+        self.assertEqual(self.evaluate("1.5GB", use_fraction=False), self.evaluate("1500MB"))
+        self.assertEqual(self.evaluate("sum([1ms, 2ms])"), self.evaluate("3ms"))
+        self.assertTrue(self.evaluate("1Gbit/s < 1GB/s"))
+        with self.assertRaises(TypeError):
+            self.evaluate("1ms + 1B")
+        with self.assertRaises(ValueError):
+            self.evaluate("10Gbit/s in s")
+
+    def test_rendering(self) -> None:
+        self.assertEqual(str(self.evaluate("10Gbit/s in MB/s")), "1250 MB/s")
+        self.assertEqual(self.evaluate("512MiB / 3ms").renderings(),
+                         ["166.6666667 GiB/s", "178.9569707 GB/s", "1.431655765 Tbit/s"])
+        self.assertEqual(str(self.evaluate("1e6ops / 2s")), "500 kops/s")
+        self.assertEqual(str(self.evaluate("90 s")), "1.5 min")
+        self.assertEqual(str(self.evaluate("1ms * 1B")), "0.008 bit*s")
+        self.assertEqual(calc.format_result(self.evaluate("4KiB * 1000"), "dec"), "3.90625 MiB")
+
+    def test_safe(self) -> None:
+        budget = calc.Budget(max_int_bits=64)
+        self.assertEqual(str(calc.evaluate("2KiB in B", True, calc.make_globals(), budget)), "2048 B")
+        with self.assertRaises(calc.LimitExceeded):
+            calc.evaluate("1KiB ^ 100", True, calc.make_globals(), budget)
+
+    def test_huge_rational(self) -> None:
+        # Rationals beyond the float range are rendered as decimals instead of failing.
+        self.assertEqual(calc.format_result(self.evaluate("10^400 / 3"), "dec"), "3.333333333333333333333333333E+399")
+
+    def test_big_power_speed(self) -> None:
+        record = bench.measure(lambda: self.evaluate("sum(k^50 for k in range(1000)) / 7"),
+                               repeat=3, min_sample_time=0, name="big power sum")
+        self.assertLess(record["stats"]["median"], 0.1, bench.format_measurement(record))
+
+
+class TestSafeEvaluator(unittest.TestCase):
+    def evaluate(self, exp: str, use_fraction: bool = True, **limits) -> object:
+        return calc.evaluate(exp, use_fraction, calc.make_globals(), calc.Budget(**limits))
+
+    def test_same_results_as_eval(self) -> None:
+        globals_dict = calc.make_globals()
+        for exp in ["1 + 2 x 3", "1/3 + 1/6", "2^-2 + 0.5", "1@2@3", "7 // 2 % 3", "-(2 << 3) | 1",
+                    "F(1, 3) * 3 == 1", "1 < 2 <= 2", "0 or 2 and 3", "3 if 1 > 2 else 4", "abs(-3)",
+                    "math.sqrt(2) * math.pi", "sum(k^2 for k in range(10) if k % 2)",
+                    "[k * 2 for k in range(3)][1:]", "max([(1, 2), (3, 4)])[1]", "F(7, 3).numerator",
+                    "sum(a * b for a, b in zip(range(3), range(3)))", "time.time() > 0"]:
+            for use_fraction in (True, False):
+                self.assertEqual(self.evaluate(exp, use_fraction), calc.evaluate(exp, use_fraction, globals_dict),
+                                 f"{exp} (fraction: {use_fraction})")
+
+    def test_rejects_unsafe_expressions(self) -> None:
+        for exp in ['__import__("os").system("true")', "().__class__.__bases__", "(lambda: 1)()",
+                    "time.sleep(10)", "math.__dict__", "open('/etc/passwd')", "[*range(3)]",
+                    "(y := 1)", "{1: 2}"]:
+            with self.assertRaises((ValueError, NameError), msg=exp):
+                self.evaluate(exp)
+
+    def test_budgets(self) -> None:
+        for exp in ["9^9^9", "2 << 10^8", "(1/3)^10^8", "math.factorial(10^7)", "math.comb(10^8, 10^7)",
+                    "range(10^12)", "'ab' * 10^9", "F('1e-999999999')", "[k for k in range(10^7 + 1)]"]:
+            with self.assertRaises(calc.LimitExceeded, msg=exp):
+                self.evaluate(exp)
+        self.assertEqual(self.evaluate("2^1000", max_int_bits=1001), 2 ** 1000)
+        with self.assertRaises(calc.LimitExceeded):
+            self.evaluate("2^1000 * 2", max_int_bits=1000)
+        with self.assertRaises(calc.LimitExceeded):
+            self.evaluate("sum(k for k in range(10^7))", timeout=0.05)
+
+    def test_results_within_budget_are_printable(self) -> None:
+        largest = self.evaluate(f"2^{calc.MAX_INT_BITS - 1}")
+        self.assertEqual(calc.format_result(largest, "dec"), str(largest))
+        with self.assertRaises(calc.LimitExceeded):
+            self.evaluate("sum([1 << 10^6] * 3)")
+
+    def test_aggregation_budgets(self) -> None:
+        self.assertEqual(self.evaluate("math.prod(range(1, 20)) + sum(range(10), 1)"), 121645100408832046)
+        for exp in ["math.prod(range(1, 300000))", "sum(F(1, k) for k in range(1, 10^6))"]:
+            with self.assertRaises(calc.LimitExceeded, msg=exp):
+                self.evaluate(exp, max_int_bits=10000)
+        with self.assertRaises(calc.LimitExceeded):
+            self.evaluate("sum([[1]] * 10^4, [])", max_items=1000)
+
+    def test_items_budget_is_cumulative(self) -> None:
+        self.assertEqual(self.evaluate("len([[0] * 100 for i in range(10)])", max_items=1010), 10)
+        for exp in ["[[0] * 100 for i in range(11)]", "[list(range(100)) for i in range(11)]",
+                    "[0] * 600 + [0] * 600"]:
+            with self.assertRaises(calc.LimitExceeded, msg=exp):
+                self.evaluate(exp, max_items=1010)
+
+    def test_alarm(self) -> None:
+        budget = calc.Budget(timeout=0.05).start()
+        with self.assertRaises(calc.LimitExceeded), budget.alarm():
+            while True:
+                pass
+        import signal
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_array_budget(self) -> None:
+        self.assertEqual(self.evaluate("np.ones(3).sum()"), 3)
+        for exp in ["np.ones(10^10)", "np.zeros((10^5, 10^5))", "np.arange(10^10)", "np.eye(10^5)"]:
+            with self.assertRaises(calc.LimitExceeded, msg=exp):
+                self.evaluate(exp)
+
+    def test_main_safe(self) -> None:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.main(["--safe", "--format", "dec", "2^10 + 1/2"])
+        self.assertEqual(out.getvalue(), "1024.5\n")
+        with self.assertRaises(calc.LimitExceeded):
+            calc.main(["--safe", "9^9^9"])
+        with patch("sys.stdin", io.StringIO("3\n")), self.assertRaises(SystemExit) as cm:
+            calc.main(["--safe", "--map", '__import__("os").getpid()'])
+        self.assertIn("--safe", str(cm.exception.code))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_evaluate_lines(self) -> None:
+        calc._init_worker(None, False)
+        text, errors = calc.evaluate_lines(10, ["1+2\n", "\n", "1 +\n", "1/0\n", "2x3\n"], True, "dec")
+        self.assertEqual(errors, 2)
+        lines = text.splitlines()
+        self.assertEqual(lines[0], "3")
+        self.assertTrue(lines[1].startswith("Error: line 12: "))
+        self.assertTrue(lines[2].startswith("Error: line 13: "))
+        self.assertEqual(lines[3], "6")
+
+    def test_run_pipeline_keeps_order(self) -> None:
+        lines = [f"{i} x 2\n" for i in range(2500)] + ["1 +\n", "7\n"]
+        out = io.StringIO()
+        with patch.object(calc, "PIPELINE_CHUNK_SIZE", 100):
+            errors = calc.run_pipeline(lines, 3, out, output_format="dec")
+        self.assertEqual(errors, 1)
+        results = out.getvalue().splitlines()
+        self.assertEqual(results[:2500], [str(i * 2) for i in range(2500)])
+        self.assertTrue(results[2500].startswith("Error: line 2501: "))
+        self.assertEqual(results[2501], "7")
+
+    def test_run_pipeline_options(self) -> None:
+        out = io.StringIO()
+        errors = calc.run_pipeline(["1/7\n", "9^9^9\n"], 2, out, output_format="dec", digits=10, safe=True)
+        self.assertEqual(errors, 1)
+        self.assertEqual(out.getvalue().splitlines()[0], "0.1428571429")
+        self.assertIn("exceeds the limit", out.getvalue())
+
+    def test_main_jobs(self) -> None:
+        out = io.StringIO()
+        with patch("sys.stdin", io.StringIO("1+2\n1 +\n3x3\n")), contextlib.redirect_stdout(out):
+            with self.assertRaises(SystemExit) as cm:
+                calc.main(["--jobs", "2", "--format", "dec"])
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(out.getvalue().splitlines()[0], "3")
+        self.assertEqual(out.getvalue().splitlines()[2], "9")
+        with self.assertRaises(SystemExit) as cm:
+            calc.main(["--jobs", "0"])
+        self.assertIn("--jobs", str(cm.exception.code))
+        with self.assertRaises(SystemExit) as cm:
+            calc.main(["--jobs", "2", "--map", "x*100"])
+        self.assertIn("--map", str(cm.exception.code))
+
+
+class TestSession(unittest.TestCase):
+    def test_variables_and_history(self) -> None:
+        session = calc.Session(True, calc.make_globals())
+        self.assertEqual(session.execute("a = 3/7"), ("a", Fraction(3, 7), 0))
+        self.assertEqual(session.execute("a x 7")[:2], ("_1", 3))
+        self.assertEqual(session.execute("_ + 1")[:2], ("_2", 4))
+        self.assertEqual(session.execute("_1 + _2")[:2], ("_3", 7))
+        self.assertEqual(session.values["_"], 7)
+        for line in ("x = 1", "F = 2", "_4 = 1", "math = 3"):
+            with self.assertRaises(ValueError, msg=line):
+                session.execute(line)
+
+    def test_functions(self) -> None:
+        session = calc.Session(True, calc.make_globals())
+        session.execute("a = 10")
+        name, f, _ = session.execute("f(x, n) = 2x + n + a")
+        self.assertEqual(repr(f), "f(x, n)")
+        self.assertEqual(session.execute("f(1, 2)")[1], 14)
+        session.execute("fact(n) = 1 if n <= 1 else n * fact(n - 1)")
+        self.assertEqual(session.execute("fact(5)")[1], 120)
+        with self.assertRaises(TypeError):
+            session.execute("f(1)")
+
+    def test_recalc_only_dependents(self) -> None:
+        session = calc.Session(True, calc.make_globals())
+        session.execute("a = 2")
+        session.execute("b = 3")
+        session.execute("c = a x 10")
+        session.execute("g(n) = n + c")
+        session.execute("g(1)")   # _1 depends on a through g and c
+        session.execute("b + 1")  # _2 depends on b only
+        self.assertEqual(session.execute("a = 5")[2], 2)
+        self.assertEqual(session.stale, {"c", "g", "_1"})
+        with patch.object(session, "evaluate_source", wraps=session.evaluate_source) as mock_evaluate:
+            self.assertEqual(session.recalc(), [("c", 50), ("_1", 51)])
+        self.assertEqual(mock_evaluate.call_count, 3)  # c, _1 and g's body
+        self.assertEqual(session.values["_2"], 4)
+        self.assertEqual(session.recalc(), [])
+
+    def test_self_reference_and_cycles(self) -> None:
+        session = calc.Session(True, calc.make_globals())
+        session.execute("a = 1")
+        session.execute("a = a + 1")
+        self.assertEqual(session.values["a"], 2)
+        session.execute("b = a x 2")
+        with self.assertRaises(ValueError):
+            session.execute("a = b")
+        self.assertEqual(session.values["a"], 2)
+
+    def test_safe_session(self) -> None:
+        session = calc.Session(True, calc.make_globals(), calc.Budget())
+        session.execute("a = 2^10")
+        session.execute("f(n) = n^a")
+        self.assertEqual(session.execute("f(2) + a")[1], 2 ** 1024 + 1024)
+        with self.assertRaises(calc.LimitExceeded):
+            session.execute("f(2^2000)")
+
+    @patch('builtins.input')
+    def test_repl_commands(self, mock_input: unittest.mock.MagicMock) -> None:
+        mock_input.side_effect = ["a = 3", "a x 2", "a = 4", ":vars", ":recalc", "exit"]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.run_repl(True, calc.make_globals(), "dec")
+        text = out.getvalue()
+        self.assertIn("# _1\n6\n", text)
+        self.assertIn("1 dependent result(s) out of date", text)
+        self.assertIn("_1 = a x 2  # 6 (stale)", text)
+        self.assertIn("_1 = 8", text)
+
+
+class TestCalcServer(unittest.TestCase):
+    def test_handle_request(self) -> None:
+        globals_dict = calc.make_globals()
+        status, out = calc.handle_request(["0", "1/3 + 1/6"], globals_dict)
+        self.assertEqual(status, 0)
+        self.assertTrue(out.startswith("1/2\n"))
+        status, out = calc.handle_request(["0", "-n", "1/4"], globals_dict)
+        self.assertIn("# Fraction: 1/4", out)
+        status, out = calc.handle_request(["1", "1 + 2"], globals_dict)
+        self.assertIn("\033[1;33m3\033[0m", out)
+        status, out = calc.handle_request(["0", "--format", "hex", "255"], globals_dict)
+        self.assertEqual((status, out), (0, "0xff\n"))
+        # The server evaluates untrusted input with the safe evaluator.
+        status, out = calc.handle_request(["0", "9^9^9"], globals_dict)
+        self.assertEqual(status, 1)
+        self.assertIn("exceeds the limit", out)
+        status, out = calc.handle_request(["0", "-p", "100000000", "1/7"], globals_dict)
+        self.assertIn("exceeds the limit", out)
+        status, out = calc.handle_request(["0", "1 +"], globals_dict)
+        self.assertEqual(status, 1)
+        self.assertIn("Error:", out)
+        status, out = calc.handle_request(["0", "[[0] * 10^7 for i in range(8)]"], globals_dict)
+        self.assertEqual(status, 1)
+        self.assertIn("items created in total exceed the limit", out)
+        with patch.object(calc, "SERVER_MAX_OUTPUT", 1000):
+            status, out = calc.handle_request(["0", "[0] * 1000"], globals_dict)
+        self.assertEqual(status, 1)
+        self.assertIn("exceeds the limit of 1000", out)
+
+    def test_server_and_client(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "calc.sock")
+            server = threading.Thread(target=calc.serve, args=(path, 0.5))
+            server.start()
+            try:
+                for _ in range(100):
+                    if os.path.exists(path):
+                        break
+                    server.join(0.01)
+                out = io.StringIO()
+                with patch.dict(os.environ, {"CALC_SOCKET": path}), contextlib.redirect_stdout(out), \
+                        patch.object(calc_client, "spawn_server") as mock_spawn:
+                    self.assertEqual(calc_client.main(["2x3", "+", "1/2"]), 0)
+                    self.assertEqual(calc_client.main(["1/0"]), 1)
+                mock_spawn.assert_not_called()
+                self.assertIn("6 + 1/2 (13/2)", out.getvalue())
+                self.assertIn("Error:", out.getvalue())
+            finally:
+                server.join()
+            # The server exits after being idle and removes its socket.
+            self.assertFalse(os.path.exists(path))
+
+    def test_client_runs_locally_without_server(self) -> None:
+        with patch.dict(os.environ, {"CALC_SOCKET": "/nonexistent/calc.sock"}), \
+                patch.object(calc_client, "spawn_server"), patch.object(calc_client, "SPAWN_TIMEOUT", 0.05), \
+                patch.object(calc_client, "run_locally", side_effect=SystemExit) as mock_local:
+            with self.assertRaises(SystemExit):
+                calc_client.main(["1+2"])
+            mock_local.assert_called_once_with(["1+2"])
+            mock_local.reset_mock()
+            with self.assertRaises(SystemExit):
+                calc_client.main(["-i"])
+            mock_local.assert_called_once_with(["-i"])
+
+    def test_client_local_flags(self) -> None:
+        for args in [[], ["--stats"], ["--map", "x+1"], ["--map=x+1"], ["--jobs=4"], ["--safe", "2^10"]]:
+            self.assertTrue(calc_client.is_local(args), args)
+        for args in [["1+2"], ["-5", "*", "2"], ["-n", "1/3"], ["2", "==", "2"]]:
+            self.assertFalse(calc_client.is_local(args), args)
+
+
+class TestMapMode(unittest.TestCase):
+    def run_map(self, exp: str, data: str, **kwargs) -> str:
+        out = io.StringIO()
+        calc.run_map(exp, io.StringIO(data), out, **kwargs)
+        return out.getvalue()
+
+    def test_compile_map_expression(self) -> None:
+        self.assertEqual(eval(calc.compile_map_expression("2x + x^2 + 0x10"), {"_x": 3}), 31)
+        # A standalone x is always the variable, never the multiplication operator.
+        with self.assertRaises(SyntaxError):
+            calc.compile_map_expression("x x 2")
+
+    def test_run_map(self) -> None:
+        self.assertEqual(self.run_map("x*1.5+3", "1\n\n2\n3\n", use_numpy=False), "4.5\n6.0\n7.5\n")
+        # Chunk boundaries and blank-only chunks don't affect the output.
+        self.assertEqual(self.run_map("x+1", "1\n\n\n\n2\n3\n", use_numpy=False, chunk_size=2),
+                         "2.0\n3.0\n4.0\n")
+        with self.assertRaises(ValueError):
+            self.run_map("x", "abc\n", use_numpy=False)
+        with self.assertRaisesRegex(ValueError, "^line 3: 0: "):
+            self.run_map("1/x", "1\n\n0\n2\n")
+        with self.assertRaisesRegex(ValueError, "^line 1: 2: "):
+            self.run_map("y", "2\n")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_run_map_numpy(self) -> None:
+        self.assertEqual(self.run_map("x*1.5+3", "1\n\n2\n3\n", use_numpy=True), "4.5\n6.0\n7.5\n")
+        self.assertEqual(self.run_map("np.sqrt(x)", "4\n9\n", use_numpy=True, chunk_size=1), "2.0\n3.0\n")
+        # A constant expression is broadcast to every input value.
+        self.assertEqual(self.run_map("7", "1\n2\n", use_numpy=True), "7\n7\n")
+        # Scalar-only expressions fall back to one evaluation per value.
+        self.assertEqual(self.run_map("math.sqrt(x)", "4\n9\n", use_numpy=True), "2.0\n3.0\n")
+        self.assertEqual(self.run_map("max(x, 2)", "1\n3\n", use_numpy=True), "2\n3.0\n")
+        self.assertEqual(self.run_map("1 if x > 2 else 0", "1\n3\n", use_numpy=True), "0\n1\n")
+
+    def test_main_map(self) -> None:
+        out = io.StringIO()
+        with patch("sys.stdin", io.StringIO("2\n4\n")), contextlib.redirect_stdout(out):
+            calc.main(["--map", "x/2"])
+        self.assertEqual(out.getvalue(), "1.0\n2.0\n")
+        with patch("sys.stdin", io.StringIO("2\n")), self.assertRaises(SystemExit) as cm:
+            calc.main(["--map=x +"])
+        self.assertIn("--map", str(cm.exception.code))
+        with patch("sys.stdin", io.StringIO("1\n0\n")), contextlib.redirect_stdout(io.StringIO()), \
+                self.assertRaises(SystemExit) as cm:
+            calc.main(["--map", "x + y"])
+        self.assertEqual(cm.exception.code, "calc.py: --map: line 1: 1: name 'y' is not defined")
+
+
+class TestStats(unittest.TestCase):
+    def test_p2_quantile(self) -> None:
+        import random
+        rng = random.Random(42)
+        values = [rng.gauss(100, 15) for _ in range(20000)]
+        ordered = sorted(values)
+        for p in [0.5, 0.9, 0.99]:
+            quantile = calc.P2Quantile(p)
+            for value in values:
+                quantile.add(value)
+            self.assertAlmostEqual(quantile.value(), ordered[int(p * len(ordered))], delta=1.0)
+        quantile = calc.P2Quantile(0.5)
+        for value in [5, 1, 3]:
+            quantile.add(value)
+        self.assertEqual(quantile.value(), 3)
+
+    def test_small_samples_are_exact(self) -> None:
+        import random
+        import statistics
+        rng = random.Random(7)
+        for values in [[1, 2, 3, 4, 100], [rng.lognormvariate(0, 1) for _ in range(20)],
+                       [rng.lognormvariate(0, 1) for _ in range(50)]]:
+            # statistics.quantiles' "inclusive" method interpolates between ranks too.
+            exact = statistics.quantiles(values, n=1000, method="inclusive")
+            for p in [0.5, 0.9, 0.99, 0.999]:
+                quantile = calc.P2Quantile(p)
+                for value in values:
+                    quantile.add(value)
+                expected = exact[round(p * 1000) - 1]
+                self.assertAlmostEqual(quantile.value(), expected, msg=f"p{p} of {len(values)} values")
+
+    def test_p2_seeded_from_exact_values(self) -> None:
+        import random
+        rng = random.Random(3)
+        values = [rng.lognormvariate(0, 1) for _ in range(calc.EXACT_QUANTILE_VALUES + 100)]
+        quantile = calc.P2Quantile(0.9)
+        for value in values:
+            quantile.add(value)
+        self.assertIsNone(quantile.values)
+        ordered = sorted(values)
+        self.assertAlmostEqual(quantile.value(), ordered[int(0.9 * len(ordered))], delta=0.15)
+
+    def test_running_stats(self) -> None:
+        import statistics
+        values = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5]
+        stats = calc.RunningStats()
+        for value in values:
+            stats.add(value)
+        aggregates = dict(stats.aggregates())
+        self.assertEqual(aggregates["count"], len(values))
+        self.assertEqual(aggregates["sum"], sum(values))
+        self.assertIs(type(aggregates["sum"]), int)
+        self.assertAlmostEqual(aggregates["mean"], statistics.mean(values))
+        self.assertAlmostEqual(aggregates["variance"], statistics.variance(values))
+        self.assertEqual((aggregates["min"], aggregates["max"]), (1, 9))
+        self.assertEqual(stats.buckets, {1101: 2, 1102: 3, 1103: 5, 1104: 1})
+        self.assertEqual(calc.bucket_range(1103), "[4, 8)")
+        self.assertEqual(calc.bucket_range(-1100), "(-1, -0.5]")
+
+    def test_non_finite(self) -> None:
+        stats = calc.RunningStats()
+        for value in [1, float("nan"), 2, float("inf"), float("-inf")]:
+            stats.add(value)
+        aggregates = dict(stats.aggregates())
+        self.assertEqual((aggregates["count"], aggregates["non-finite"]), (2, 3))
+        self.assertEqual((aggregates["sum"], aggregates["min"], aggregates["max"]), (3, 1, 2))
+        self.assertEqual(aggregates["mean"], 1.5)
+        self.assertEqual(aggregates["p50"], 1.5)
+        self.assertEqual(stats.buckets, {1101: 1, 1102: 1})
+
+        stats.add(10 ** 400)
+        self.assertEqual((stats.count, stats.non_finite), (2, 4))
+
+        out = io.StringIO()
+        calc.run_stats(["nan\n"], out)
+        self.assertEqual(out.getvalue().splitlines(), ["count       0  0x0", "non-finite  1  0x1"])
+
+    def test_run_stats(self) -> None:
+        out = io.StringIO()
+        with patch("sys.stderr", new_callable=io.StringIO) as err:
+            errors = calc.run_stats(["4096\n", "\n", "abc\n", "0x1000\n", "4096.0\n"], out)
+        self.assertEqual(errors, 1)
+        self.assertIn("line 3", err.getvalue())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "count     3  0x3")
+        self.assertIn("sum       12_288  0x3000", lines)
+        self.assertIn("max       4_096  0x1000", lines)
+        self.assertEqual(lines[-2:], ["# Histogram", "[4096, 8192)  3  " + "#" * 40])
+
+        out = io.StringIO()
+        calc.run_stats(["1\n", "2\n"], out, "hex")
+        self.assertEqual(out.getvalue().splitlines()[:2], ["count\t0x2", "sum\t0x3"])
+
+    def test_main_stats(self) -> None:
+        out = io.StringIO()
+        with patch("sys.stdin", io.StringIO("10\n20\n30\n")), contextlib.redirect_stdout(out):
+            calc.main(["--stats", "--format", "dec"])
+        self.assertIn("mean\t20.0", out.getvalue().splitlines())
+        with self.assertRaises(SystemExit):
+            calc.main(["--stats", "--map", "x"])
+
+
+class TestOutputFormats(unittest.TestCase):
+    def test_to_signed(self) -> None:
+        self.assertEqual(calc.to_signed(0x7fffffff, 32), 0x7fffffff)
+        self.assertEqual(calc.to_signed(0x80000000, 32), -0x80000000)
+        self.assertEqual(calc.to_signed(0x10000000, 32), 0x10000000)
+        self.assertEqual(calc.to_signed(-1, 64), -1)
+
+    def test_format_result(self) -> None:
+        self.assertEqual(calc.format_result(Fraction(255), "dec"), "255")
+        self.assertEqual(calc.format_result(Fraction(1, 4), "dec"), "0.25")
+        self.assertEqual(calc.format_result(255, "hex"), "0xff")
+        self.assertEqual(calc.format_result(-255, "hex"), "-0xff")
+        self.assertEqual(calc.format_result(5, "bin"), "0b101")
+        self.assertEqual(calc.format_result(2 ** 31, "i32"), "-2147483648")
+        self.assertEqual(calc.format_result(-1, "u64"), "18446744073709551615")
+        self.assertEqual(calc.format_result(1000, "time"), "1970-01-01 00:00:01.000")
+        self.assertEqual(calc.format_result(-1, "time"), "n/a")
+        self.assertEqual(calc.format_result(float("nan"), "hex"), "n/a")
+        self.assertEqual(calc.format_result("abc", "hex"), "abc")
+
+    def test_format_result_json(self) -> None:
+        obj = json.loads(calc.format_result(Fraction(1, 2), "json"))
+        self.assertEqual(obj["value"], "1/2")
+        self.assertEqual(obj["dec"], "0.5")
+        self.assertEqual(set(obj), {"value"} | set(calc.FORMATTERS))
+        obj = json.loads(calc.format_result(-1, "json"))
+        self.assertEqual((obj["hex"], obj["i32"], obj["time"]), ("-0x1", "-1", None))
+
+    def test_main_format(self) -> None:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calc.main(["--format", "hex", "2^8 - 1"])
+            calc.main(["--format=i32", "2^32 - 1"])
+        self.assertEqual(out.getvalue(), "0xff\n-1\n")
+        out = io.StringIO()
+        with patch("sys.stdin", io.StringIO("1+2\n1/3\n")), contextlib.redirect_stdout(out):
+            calc.main(["--format", "json"])
+        self.assertEqual([json.loads(line)["value"] for line in out.getvalue().splitlines()], ["3", "1/3"])
+        with self.assertRaises(SystemExit) as cm:
+            calc.main(["--format", "oct", "1"])
+        self.assertIn("unknown format", str(cm.exception.code))
+
+    def test_map_format(self) -> None:
+        out = io.StringIO()
+        calc.run_map("x*16", io.StringIO("1\n2\n"), out, use_numpy=False, output_format="hex")
+        self.assertEqual(out.getvalue(), "0x10\n0x20\n")
+
+
 class TestCalcExecution(unittest.TestCase):
     def run_calc(self, args: list[str], stdin_data: str = "", stdout_class=io.StringIO) -> str:
         old_stdout = sys.stdout
@@ -278,5 +909,65 @@ class TestCalcExecution(unittest.TestCase):
         mock_input.assert_called_with("\033[1;32mcalc> \033[0m")
 
 
+class TestCalcPerformance(unittest.TestCase):
+    """Micro-benchmarks with generous budgets, to catch gross regressions in the hot paths."""
+
+    def test_preprocess_expression_speed(self) -> None:
+        record = bench.measure(lambda: calc.preprocess_expression("1,000_000 x 2^3 + 007"),
+                               repeat=10, min_sample_time=0.005, name="preprocess_expression")
+        self.assertLess(record["stats"]["median"], 0.001, bench.format_measurement(record))
+
+    def test_evaluation_speed(self) -> None:
+        sink = io.StringIO()
+        def evaluate() -> None:
+            sink.seek(0)
+            sink.truncate()
+            with contextlib.redirect_stdout(sink):
+                calc.main(["1/3 + 1/6"])
+        old_argv = sys.argv
+        try:
+            record = bench.measure(evaluate, repeat=10, min_sample_time=0.01, name="calc.main")
+        finally:
+            sys.argv = old_argv
+        self.assertLess(record["stats"]["median"], 0.01, bench.format_measurement(record))
+
+    def test_batch_evaluation_speed(self) -> None:
+        # Repeated lines hit the compile cache, so piped input is dominated by evaluation.
+        stdin_data = "1/3 + 1/6\n2x3\n" * 500
+        def evaluate() -> None:
+            with patch("sys.stdin", io.StringIO(stdin_data)), contextlib.redirect_stdout(io.StringIO()):
+                calc.main([])
+        old_argv = sys.argv
+        try:
+            record = bench.measure(evaluate, repeat=3, min_sample_time=0, name="calc.main batch")
+        finally:
+            sys.argv = old_argv
+        self.assertLess(record["stats"]["median"], 1.0, bench.format_measurement(record))
+
+    def test_startup_time(self) -> None:
+        # A one-shot evaluation in a fresh interpreter, as run from a shell prompt.
+        calc_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calc.py")
+        times = []
+        for _ in range(5):
+            elapsed, returncode, _ = bench.run_once([sys.executable, calc_path, "1+2"],
+                                                    subprocess.DEVNULL, None)
+            self.assertEqual(returncode, 0)
+            times.append(elapsed)
+        self.assertLess(min(times), 0.25, f"calc.py 1+2 took {min(times):.3f}s")
+
+    def test_map_throughput(self) -> None:
+        data = "".join(f"{i}\n" for i in range(100000))
+        record = bench.measure(lambda: calc.run_map("x*1.5+3", io.StringIO(data), io.StringIO()),
+                               repeat=3, min_sample_time=0, name="run_map 100k rows")
+        self.assertLess(record["stats"]["median"], 2.0, bench.format_measurement(record))
+
+    def test_safe_evaluation_speed(self) -> None:
+        budget = calc.Budget()
+        globals_dict = calc.make_globals()
+        record = bench.measure(lambda: calc.evaluate("(1/3 + 2^10) x 3 - math.sqrt(2)", True, globals_dict, budget),
+                               repeat=10, min_sample_time=0.005, name="safe evaluate")
+        self.assertLess(record["stats"]["median"], 0.001, bench.format_measurement(record))
+
+
 if __name__ == '__main__':
     unittest.main()
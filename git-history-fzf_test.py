@@ -24,6 +24,16 @@ git_history_fzf: Any = importlib.util.module_from_spec(spec)
 sys.modules["git_history_fzf"] = git_history_fzf
 spec.loader.exec_module(git_history_fzf)
 
+# Load the bench script (also extensionless) for the micro-benchmarks.
+bench_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+bench_loader: importlib.machinery.SourceFileLoader = importlib.machinery.SourceFileLoader("bench", bench_path)
+bench_spec: Optional[importlib.machinery.ModuleSpec] = importlib.util.spec_from_file_location("bench", bench_path, loader=bench_loader)
+if bench_spec is None or bench_spec.loader is None:
+    raise ImportError("Could not load bench")
+bench: Any = importlib.util.module_from_spec(bench_spec)
+sys.modules["bench"] = bench
+bench_spec.loader.exec_module(bench)
+
 def make_mock_proc(stdout: bytes = b"", returncode: int = 0) -> MagicMock:
     proc = MagicMock()
     proc.stdout = BytesIO(stdout)
@@ -204,6 +214,15 @@ class GitHistoryFzfTest(unittest.TestCase):
             b"12345ab \x1b[36m[2026-06-08]\x1b[m \x1b[35m<user@example.com>\x1b[m \x1b[32m[master, \x1b[33mupstream-base\x1b[32m]\x1b[m Initial commit\n"
         )
 
+
+    def test_format_line_performance(self) -> None:
+        # format_line() runs for every commit of the log; keep it well under the fzf refresh budget.
+        line: bytes = b"abc1234\x002024-01-01 10:00\x00a@b.com\x00HEAD -> main, origin/main, tag: v1\x00Subject\n"
+        merge_bases: Set[bytes] = {b"abc1234" + b"0" * 33}
+        record: Dict[str, Any] = bench.measure(lambda: git_history_fzf.format_line(line, merge_bases=merge_bases),
+                                              repeat=10, min_sample_time=0.005, name="format_line")
+        self.assertLess(record["stats"]["median"], 0.001, bench.format_measurement(record))
+
     @patch('git_history_fzf.is_inside_work_tree')
     @patch('subprocess.Popen')
     def test_main_standard_flow(self, mock_popen: MagicMock, mock_is_inside: MagicMock) -> None: